@@ -1,14 +1,16 @@
 import copy
-import glob
 import json
 import logging
 import os
 from pathlib import Path
 import time
 from datetime import datetime
+from parallel_scanner import ParallelDirectoryScanner
+from scan_rules import ScanRules
 from snapshot import Snapshot
+from snapshot_diff import SnapshotDiff
 
-class DirectorySnapshot:
+class DirectorySnapshot(Snapshot):
 
     def __init__(self, log:logging.Logger, rootDir:Path):
         Snapshot.__init__(self, "-VS.json")  
@@ -16,9 +18,9 @@ class DirectorySnapshot:
         self._rootdir = rootDir
         self._snapshot = {"elements":[]}
 
-        config = Snapshot.readjson_config()
+        config = self.readjson_config()
         if config and "DIRECTORY_HYSTORY_DIR" in config :
-            Snapshot.HYSTORY_DIR = config["DIRECTORY_HYSTORY_DIR"]
+            Snapshot.HYSTORY_DIR = Path(config["DIRECTORY_HYSTORY_DIR"])
             self.log.info(f"monitoring_config.json: set DIRECTORY_HYSTORY_DIR={Snapshot.HYSTORY_DIR}")
         else:
             Snapshot.HYSTORY_DIR = Path.cwd() / "system" / "directorystructure_snapshots"
@@ -41,10 +43,36 @@ class DirectorySnapshot:
             retlist = [el for el in self._snapshot["elements"] if el["type"] == file_or_dir ]
         return retlist 
 
-    def create_snapshot(self, overwrite=False, only_one_dir=False) -> tuple:
+    def create_snapshot(self, overwrite=False, only_one_dir=False, scanner:ParallelDirectoryScanner=None,
+                        rules:ScanRules=None) -> tuple:
+        return self.create_snapshot_for_roots([self._rootdir], only_one_dir, scanner, rules)
+
+    def create_snapshot_for_roots(self, roots:list, only_one_dir=False, scanner:ParallelDirectoryScanner=None,
+                                  rules:ScanRules=None) -> tuple:
+        # several scan roots (zone W) in one snapshot, all walked with the same rules
         start_time = time.time()           
         totalbytes = 0  
-        for dir, _, files in os.walk(self._rootdir):
+        # excluded subtrees are pruned during the walk (default rules: only the md5 sidecars)
+        rules = rules if rules else ScanRules()
+        for rootdir in roots:
+            totalbytes += self.add_tree(rootdir, only_one_dir, scanner, rules)
+
+        runtime = time.time() - start_time
+        seconds = int(runtime)
+        milliseconds = int((runtime - seconds) * 1000) 
+        print(f"Runtime: {seconds}.{milliseconds:03d} seconds")
+        self._snapshot["runtime"] = f"{seconds}.{milliseconds:03d}"
+        self._snapshot["created"] = start_time     # the tree as of this time (file mtimes change with compact)
+        self._snapshot["total_byte_size"] = f"{totalbytes:,}".replace(",", "'")
+        # what the snapshot leaves out --> e.g. the transfer planner doesn't take it as the complete tree
+        self._snapshot["scan_rules"] = rules.describe()
+        self._snapshot["only_one_dir"] = only_one_dir
+        return (runtime, totalbytes)
+
+    def add_tree(self, rootdir:Path, only_one_dir:bool, scanner:ParallelDirectoryScanner, rules:ScanRules) -> int:
+        totalbytes = 0
+        # scanner: concurrent listing/stat (network filesystems), same order as os.walk
+        for dir, _, files, file_sizes in rules.walk(rootdir, scanner):
             dir_path = Path(dir)
             self._snapshot["elements"].append(
                 {"type" : "DIR", 
@@ -53,10 +81,8 @@ class DirectorySnapshot:
                  }) 
             
             for filename in files:
-                if filename.startswith(".md5_hashes"):  #don't put it in the snapshot 
-                    continue
                 file_path = dir_path / filename
-                nr_of_bytes = file_path.stat().st_size                               
+                nr_of_bytes = file_sizes[filename] if filename in file_sizes else file_path.stat().st_size
                 self._snapshot["elements"].append(
                     {"type" : "FILE", 
                      "path" : file_path.as_posix(), 
@@ -66,24 +92,28 @@ class DirectorySnapshot:
                 totalbytes = totalbytes + nr_of_bytes
             if only_one_dir: 
                 break  # stop walking down the tree ... just snapshot the rootdir.
-
-        runtime = time.time() - start_time
-        seconds = int(runtime)
-        milliseconds = int((runtime - seconds) * 1000) 
-        print(f"Runtime: {seconds}.{milliseconds:03d} seconds")
-        self._snapshot["runtime"] = f"{seconds}.{milliseconds:03d}"
-        self._snapshot["total_byte_size"] = f"{totalbytes:,}".replace(",", "'")
-        return (runtime, totalbytes)
+        return totalbytes
  
     def load_snapshot(self, number:int):
-        search_pattern = os.path.join(Snapshot.HYSTORY_DIR, f"{number:04d}-*-VS.json")
-        matching_files = glob.glob(search_pattern)
-        if matching_files: 
-            self.read_json_snapshot_file(matching_files[0])
+        # plain json, base and delta snapshots --> the store reconstructs the delta chain
+        self._snapshot = self.get_snapshot_store(Snapshot.HYSTORY_DIR).load(number)
     
     def load_last_snapshot(self):
-        file_path = Snapshot.HYSTORY_DIR / Snapshot.get_last_snapshot_filename() 
-        self.read_json_snapshot_file(file_path)
+        store = self.get_snapshot_store(Snapshot.HYSTORY_DIR)
+        self._snapshot = store.load(store.get_last_snapshot_number())
+
+    def load_subtree(self, dir_path:Path, number:int=None):
+        # only dir_path and below are read from the snapshot (directory offset index)
+        reader = self.get_snapshot_reader(Snapshot.HYSTORY_DIR, number)
+        self._snapshot = reader.load_subtree(Path(dir_path).as_posix())
+
+    def iter_snapshot_elements(self, number:int=None, dir_path:Path=None):
+        reader = self.get_snapshot_reader(Snapshot.HYSTORY_DIR, number)
+        yield from reader.iter_elements(Path(dir_path).as_posix() if dir_path else None)
+
+    def save_snapshot(self) -> Path:
+        store = self.get_snapshot_store(Snapshot.HYSTORY_DIR)
+        return store.save(store.get_last_snapshot_number() + 1, self._snapshot)
     
     def diff_snapshot(self, older_snapshot: 'DirectorySnapshot'):
         diff_list = {}
@@ -139,8 +169,8 @@ def create_snapshot():
     src = r"C:\tmp\testsrc"
     src = r"D:\Games\World_of_Tanks"
     snapshot = DirectorySnapshot(log, src)
-    runtime, totalbytes = snapshot.create_snapshot()
-    #snapshot.save_snapshot()
+    runtime, totalbytes = snapshot.create_snapshot(scanner=ParallelDirectoryScanner.from_config(snapshot.readjson_config()))
+    snapshot.save_snapshot()
 
     print(f"Runtime: --- {runtime:.3f} seconds.  Bytes={totalbytes}")  
     print("main(): all done")
@@ -149,13 +179,11 @@ def print_snapshots(log:logging.Logger):
     src = r"C:\tmp\testsrc"
     src = r"D:\Games\World_of_Tanks"
     last_snapshot = DirectorySnapshot(log, src)
-    last_snapshot.load_last_snapshot()
-    second_snapshot = DirectorySnapshot(log, src)
-    second_snapshot.load_snapshot(2)
+    store = last_snapshot.get_snapshot_store(Snapshot.HYSTORY_DIR)
 
-    diff_list = last_snapshot.diff_snapshot(second_snapshot)
-    for key, value in diff_list.items():
-        print(f"{value} ¦ {key}")
+    # streamed into compressed reports under system/reports (constant memory), only the summary is printed
+    summary = SnapshotDiff.from_config(last_snapshot.readjson_config()).diff_history(store, 2, store.get_last_snapshot_number())
+    SnapshotDiff.print_summary(summary)
 
     # for el in last_snapshot.get_element_list():
     #     print(el)
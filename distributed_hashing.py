@@ -0,0 +1,385 @@
+import argparse
+import hashlib
+import heapq
+import json
+import logging
+import logging.config
+import os
+from pathlib import Path
+import shutil
+import socket
+import threading
+import time
+
+from hash_cache import HashCache
+from io_throttle import HashingWindowClosed, IOThrottle
+from md5dir import MD5Dir
+from md5_snapshot import MD5Snapshot
+
+
+class ShardQueue:
+    """
+        File based work queue on a shared filesystem (NFS/CephFS), no server required.
+        Every coordinator run gets its own generation directory, older ones are removed
+        when a new run is published --> a reused queue dir never mixes results of two runs:
+            <queue_dir>/current_run                       id of the published run
+            <queue_dir>/runs/<run>/shards/shard-0001.json    file list of the shard (balanced by bytes)
+            <queue_dir>/runs/<run>/locks/shard-0001.lock     claimed by a worker (O_CREAT|O_EXCL), mtime = heartbeat
+            <queue_dir>/runs/<run>/results/shard-0001.json   md5 values + content hash of the shard, written atomically
+        A lock whose heartbeat is older than the lease timeout belongs to a crashed worker
+        and gets reclaimed by the next worker.
+    """
+
+    LEASE_TIMEOUT = 600     # seconds
+    CURRENT_RUN_FILENAME = "current_run"
+
+    def __init__(self, queue_dir:Path, lease_timeout:float=LEASE_TIMEOUT):
+        self.log = logging.getLogger(os.path.basename(__file__))
+        self._queue_dir = Path(queue_dir)
+        self._lease_timeout = lease_timeout
+        self._queue_dir.mkdir(parents=True, exist_ok=True)
+        self._run_id = self.read_current_run()
+
+    #region properties
+    @property
+    def run_id(self) -> str:
+        return self._run_id
+
+    @property
+    def run_dir(self) -> Path:
+        return self._queue_dir / "runs" / str(self._run_id)
+
+    @property
+    def shards_dir(self) -> Path:
+        return self.run_dir / "shards"
+
+    @property
+    def locks_dir(self) -> Path:
+        return self.run_dir / "locks"
+
+    @property
+    def results_dir(self) -> Path:
+        return self.run_dir / "results"
+
+    @property
+    def lease_timeout(self):
+        return self._lease_timeout
+    #endregion properties
+
+    #region runs
+    def read_current_run(self) -> str:
+        try:
+            with open(self._queue_dir / ShardQueue.CURRENT_RUN_FILENAME, "r", encoding='utf-8') as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def refresh(self) -> bool:
+        """ follows the run published by the coordinator, returns True if it changed """
+        run_id = self.read_current_run()
+        changed = run_id != self._run_id
+        self._run_id = run_id
+        return changed
+
+    def start_run(self) -> str:
+        """ new, not yet published generation (the coordinator publishes it with publish_shards) """
+        self._run_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{socket.gethostname()}-{os.getpid()}-{os.urandom(4).hex()}"
+        for sub_dir in [self.shards_dir, self.locks_dir, self.results_dir]:
+            sub_dir.mkdir(parents=True, exist_ok=True)
+        return self._run_id
+
+    def remove_other_runs(self):
+        runs_dir = self._queue_dir / "runs"
+        for run_dir in runs_dir.iterdir():
+            if run_dir.name != self._run_id:
+                shutil.rmtree(run_dir, ignore_errors=True)
+    #endregion runs
+
+    def get_shard_names(self) -> list:
+        return sorted(f.stem for f in self.shards_dir.glob("shard-*.json"))
+
+    def lock_path(self, shard_name:str) -> Path:
+        return self.locks_dir / f"{shard_name}.lock"
+
+    def result_path(self, shard_name:str) -> Path:
+        return self.results_dir / f"{shard_name}.json"
+
+    def write_json_atomic(self, file_path:Path, data:dict):
+        tmp_path = file_path.with_name(f".{file_path.name}.{socket.gethostname()}-{os.getpid()}.tmp")
+        with open(tmp_path, "w", encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, file_path)
+
+    def read_json(self, file_path:Path) -> dict:
+        with open(file_path, "r", encoding='utf-8') as f:
+            return json.load(f)
+
+    #region shards
+    @staticmethod
+    def split_into_shards(file_sizes:dict, nrof_shards:int) -> list:
+        """ greedy balancing by bytes: biggest file first into the currently smallest shard """
+        shards = [{"bytes": 0, "files": []} for _ in range(max(1, nrof_shards))]
+        heap = [(0, i) for i in range(len(shards))]
+        for file_name, size in sorted(file_sizes.items(), key=lambda item: item[1], reverse=True):
+            shard_bytes, i = heapq.heappop(heap)
+            shards[i]["files"].append([file_name, size])
+            shards[i]["bytes"] = shard_bytes + size
+            heapq.heappush(heap, (shard_bytes + size, i))
+        return [shard for shard in shards if shard["files"]]
+
+    def publish_shards(self, shards:list):
+        """ writes the shards of a new run, makes it the current run and removes the older runs """
+        self.start_run()
+        for i, shard in enumerate(shards, start=1):
+            self.write_json_atomic(self.shards_dir / f"shard-{i:04d}.json", shard)
+        with open(self._queue_dir / f".{ShardQueue.CURRENT_RUN_FILENAME}.tmp", "w", encoding='utf-8') as f:
+            f.write(self._run_id)
+        os.replace(self._queue_dir / f".{ShardQueue.CURRENT_RUN_FILENAME}.tmp", self._queue_dir / ShardQueue.CURRENT_RUN_FILENAME)
+        self.remove_other_runs()
+        self.log.info(f"published {len(shards)} shards in {self.shards_dir}")
+
+    def read_shard(self, shard_name:str) -> tuple:
+        """ returns (shard, content hash of the shard file) """
+        with open(self.shards_dir / f"{shard_name}.json", "rb") as f:
+            data = f.read()
+        return (json.loads(data), hashlib.md5(data).hexdigest())
+    #endregion shards
+
+    #region claiming
+    def try_claim(self, shard_name:str, owner:str) -> bool:
+        if self.result_path(shard_name).exists():
+            return False
+        lock_path = self.lock_path(shard_name)
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileNotFoundError:
+            return False    # the run was replaced by a newer one
+        except FileExistsError:
+            if not self.reclaim_if_expired(shard_name):
+                return False
+            try:
+                fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                return False    # another worker was faster
+        with os.fdopen(fd, "w", encoding='utf-8') as f:
+            json.dump({"owner": owner, "claimed": time.time()}, f)
+        if self.result_path(shard_name).exists():    # finished in the meantime
+            self.release(shard_name, owner)
+            return False
+        return True
+
+    def reclaim_if_expired(self, shard_name:str) -> bool:
+        lock_path = self.lock_path(shard_name)
+        try:
+            age = time.time() - lock_path.stat().st_mtime
+        except FileNotFoundError:
+            return True
+        if age < self._lease_timeout:
+            return False
+        # stat + rename are not atomic together: between them another worker may already have
+        # reclaimed the lock and created a fresh one --> check what was renamed, put a fresh lock back
+        stale_path = lock_path.with_name(f"{lock_path.name}.stale-{socket.gethostname()}-{os.getpid()}-{threading.get_ident()}")
+        try:
+            os.rename(lock_path, stale_path)
+        except FileNotFoundError:
+            return True
+        try:
+            renamed_age = time.time() - stale_path.stat().st_mtime
+        except FileNotFoundError:
+            return False
+        if renamed_age < self._lease_timeout:
+            try:
+                os.link(stale_path, lock_path)     # no-clobber restore
+            except FileExistsError:
+                self.log.warning(f"{shard_name}: fresh lock of another worker could not be restored, shard may be hashed twice")
+            os.remove(stale_path)
+            return False
+        os.remove(stale_path)
+        self.log.warning(f"reclaimed {shard_name}: lease expired {age:.0f} seconds after the last heartbeat")
+        return True
+
+    def heartbeat(self, shard_name:str):
+        try:
+            os.utime(self.lock_path(shard_name))
+        except FileNotFoundError:
+            pass
+
+    def release(self, shard_name:str, owner:str):
+        # only remove our own lock: after an expired lease the lock belongs to another worker
+        try:
+            if self.read_json(self.lock_path(shard_name)).get("owner") == owner:
+                os.remove(self.lock_path(shard_name))
+        except (FileNotFoundError, json.JSONDecodeError):
+            pass
+    #endregion claiming
+
+    def get_open_shards(self) -> list:
+        if self._run_id is None:
+            return []
+        return [name for name in self.get_shard_names() if not self.result_path(name).exists()]
+
+
+class ShardWorker:
+    """ Claims shards from the queue and hashes their files until no shard is left. """
+
+    def __init__(self, queue:ShardQueue, throttle:IOThrottle=None):
+        self.log = logging.getLogger(os.path.basename(__file__))
+        self._queue = queue
+        self._throttle = throttle
+        self._owner = f"{socket.gethostname()}-{os.getpid()}-{threading.get_ident()}"
+
+    def run(self, wait_for_others:bool=False, poll_interval:float=10) -> int:
+        """ returns the number of shards hashed by this worker """
+        if self._throttle:
+            # nice/ioprio only for a dedicated hashing thread, the caller keeps its priority
+            return self._throttle.run_in_thread(self._run, wait_for_others, poll_interval)
+        return self._run(wait_for_others, poll_interval)
+
+    def _run(self, wait_for_others:bool, poll_interval:float) -> int:
+        done = 0
+        while True:
+            if self._queue.refresh():
+                self.log.info(f"worker {self._owner}: working on run {self._queue.run_id}")
+            open_shards = self._queue.get_open_shards()
+            if not open_shards:
+                break
+            claimed = False
+            for shard_name in open_shards:
+                if self._queue.try_claim(shard_name, self._owner):
+                    claimed = True
+                    try:
+                        self.hash_shard(shard_name)
+                    except HashingWindowClosed:
+                        # the lock is released, the shard stays open for the next window
+                        self.log.info(f"worker {self._owner}: outside of the hashing time windows --> stopped")
+                        return done
+                    done += 1
+            if not claimed:
+                if not wait_for_others:
+                    break
+                time.sleep(poll_interval)   # others are busy; their shards may expire
+        self.log.info(f"worker {self._owner}: {done} shards hashed")
+        return done
+
+    def hash_shard(self, shard_name:str):
+        start_time = time.time()
+        shard, shard_hash = self._queue.read_shard(shard_name)
+        stop_heartbeat = threading.Event()
+        def heartbeat():
+            while not stop_heartbeat.wait(self._queue.lease_timeout / 4):
+                self._queue.heartbeat(shard_name)
+        heartbeat_thread = threading.Thread(target=heartbeat, daemon=True)
+        heartbeat_thread.start()
+        try:
+            result = {"owner": self._owner, "run": self._queue.run_id, "shard_hash": shard_hash,
+                      "files": {}, "missing": [], "bytes": 0}
+            for file_name, size in shard["files"]:
+                try:
+                    result["files"][file_name] = MD5Dir.get_md5(Path(file_name), "snapshot", throttle=self._throttle)
+                    result["bytes"] += size
+                except FileNotFoundError:
+                    result["missing"].append(file_name)
+            result["runtime"] = time.time() - start_time
+            try:
+                self._queue.write_json_atomic(self._queue.result_path(shard_name), result)
+            except FileNotFoundError:
+                self.log.warning(f"{shard_name}: run {self._queue.run_id} was replaced, result discarded")
+                return
+        finally:
+            stop_heartbeat.set()
+            heartbeat_thread.join()
+            self._queue.release(shard_name, self._owner)
+        self.log.info(f"{shard_name}: {len(shard['files'])} files, {result['bytes']:,} bytes in {result['runtime']:.3f} seconds")
+
+
+class ShardCoordinator:
+    """ Splits the file list of an md5 snapshot into shards and merges the worker results. """
+
+    SHARD_BYTES = 50_000_000_000    # default shard size if no number of shards is given
+
+    def __init__(self, queue:ShardQueue):
+        self.log = logging.getLogger(os.path.basename(__file__))
+        self._queue = queue
+
+    def prepare(self, md5_snapshot:MD5Snapshot, rootdir:Path, nrof_shards:int=0) -> int:
+        md5_snapshot.create_md5_snapshot_files(rootdir)
+        file_sizes = {}
+        for file_name, md5 in md5_snapshot.snapshot["files"].items():
+            if md5 != "xxx":
+                continue    # already done in a previous run
+            try:
+                file_sizes[file_name] = Path(file_name).stat().st_size
+            except FileNotFoundError:
+                pass
+        for file_name in [f for f, md5 in md5_snapshot.snapshot["files"].items() if md5 == "xxx" and f not in file_sizes]:
+            self.log.warning(f"file vanished before sharding: {file_name}")
+            del md5_snapshot.snapshot["files"][file_name]
+        if nrof_shards <= 0:
+            nrof_shards = max(1, -(-sum(file_sizes.values()) // ShardCoordinator.SHARD_BYTES))
+        shards = ShardQueue.split_into_shards(file_sizes, nrof_shards)
+        self._queue.publish_shards(shards)
+        return len(shards)
+
+    def wait_for_results(self, poll_interval:float=10, timeout:float=None):
+        start = time.time()
+        while self._queue.get_open_shards():
+            if timeout is not None and time.time() - start > timeout:
+                raise TimeoutError(f"open shards after {timeout} seconds: {self._queue.get_open_shards()}")
+            time.sleep(poll_interval)
+
+    def merge(self, md5_snapshot:MD5Snapshot) -> Path:
+        """ merges all shard results into the snapshot and saves it as new -md5.json history entry """
+        files = md5_snapshot.snapshot["files"]
+        runtime = 0.0
+        for shard_name in self._queue.get_shard_names():
+            result = self._queue.read_json(self._queue.result_path(shard_name))
+            _, shard_hash = self._queue.read_shard(shard_name)
+            if result.get("run") != self._queue.run_id or result.get("shard_hash") != shard_hash:
+                raise ValueError(f"{shard_name}: result does not belong to the shard of run {self._queue.run_id}")
+            files.update(result["files"])
+            for file_name in result["missing"]:
+                self.log.warning(f"file vanished before hashing: {file_name}")
+                files.pop(file_name, None)
+            md5_snapshot.totalbytes += result["bytes"]
+            md5_snapshot.nroffiles += len(result["files"])
+            runtime = max(runtime, result["runtime"])
+        md5_snapshot.runtime += runtime    # wall clock: the slowest shard
+        not_hashed = [file_name for file_name, md5 in files.items() if md5 == "xxx"]
+        if not_hashed:
+            # the IN_PROGRESS checkpoint stays, a new prepare() shards the rest
+            raise RuntimeError(f"{len(not_hashed)} files without md5 after merging, e.g. {not_hashed[0]}")
+        return md5_snapshot.finish_md5_snapshot()
+
+
+def main():
+    with open("logging.json", "r") as f:
+        log_config = json.load(f)
+        logging.config.dictConfig(log_config)
+    log = logging.getLogger(os.path.basename(__file__))
+
+    parser = argparse.ArgumentParser(description="sharded md5 hashing over a shared filesystem")
+    parser.add_argument("mode", choices=["coordinator", "worker"])
+    parser.add_argument("queue_dir")
+    parser.add_argument("--rootdir", help="coordinator: tree to hash")
+    parser.add_argument("--shards", type=int, default=0, help="coordinator: number of shards (default: by size)")
+    parser.add_argument("--lease", type=float, default=ShardQueue.LEASE_TIMEOUT, help="lease timeout in seconds")
+    args = parser.parse_args()
+
+    queue = ShardQueue(Path(args.queue_dir), args.lease)
+    if args.mode == "worker":
+        snap_config = MD5Snapshot(log).readjson_config()
+        MD5Dir.hash_cache = HashCache.from_config(snap_config)
+        ShardWorker(queue, IOThrottle.from_config(snap_config)).run(wait_for_others=True)
+        if MD5Dir.hash_cache:
+            MD5Dir.hash_cache.close()
+    else:
+        snap = MD5Snapshot(log)
+        coordinator = ShardCoordinator(queue)
+        log.info(f"{coordinator.prepare(snap, Path(args.rootdir), args.shards)} shards published")
+        coordinator.wait_for_results()
+        log.info(f"merged snapshot: {coordinator.merge(snap)}")
+
+if __name__ == "__main__":
+    main()
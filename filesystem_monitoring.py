@@ -1,11 +1,24 @@
 
+import json
+import logging
+import os
+from pathlib import Path
+import sys
+import time
+
+from directory_snapshot import DirectorySnapshot
 from jsonconfig import JsonConfig
 from integrity_data_mover import IntegrityDataMover
-from md5_snapshot import MD5Snapshot
+from hash_cache import HashCache
+from md5dir import MD5Dir
+from parallel_scanner import ParallelDirectoryScanner
+from scan_rules import ScanRules
+from transfer_planner import TransferPlanner
 
 
 class FilesystemMonitoring:
-    def __init__(self):
+    def __init__(self, dry_run=False):
+        self.__dry_run = dry_run   # only plan the transfers, nothing is copied or deleted
         self.__zone_s_conf = JsonConfig("zone_s_config.json")
         self.__zone_w_conf = JsonConfig("zone_w_config.json")
         self.__zone_transfers_conf = JsonConfig("zone_transfers_config.json")
@@ -18,56 +31,122 @@ class FilesystemMonitoring:
     def zone_w_list(self):
         return self.__zone_w_conf.getvalue("directories")
     
+    @property
+    def zone_w_scan_plan(self) -> tuple:
+        # (scan roots, ScanRules): "*" and wildcard entries expanded, zone S dirs excluded
+        return ScanRules.plan_zone_w(self.zone_w_list, self.zone_s_list, self.__zone_w_conf.data.get("rules"))
+
     @property
     def zone_transfers_list(self):
         return self.__zone_transfers_conf.getvalue("transfers")
     
     def run(self):
-        # 1. go through the zone-transfer-list and move whats required there
+        # one hash cache for all jobs of this run: source hashing, validation, snapshots
+        MD5Dir.hash_cache = HashCache.open_from_monitoring_config()
+        MD5Dir.configure_block_mode(self.read_monitoring_config())
         try:
-            self.zone_transfers_runner()
-        except FileExistsError as fe:
-            print(f"run(): zone_transfers_runner->aborted! {fe}")
-        
+            # 1. go through the zone-transfer-list and move whats required there
+            try:
+                self.zone_transfers_runner()
+            except FileExistsError as fe:
+                print(f"run(): zone_transfers_runner->aborted! {fe}")
 
-        # 2. directory-structure monintoring
+            # 2. directory-structure monintoring
+            self.zone_w_snapshot_runner()
 
-        # 3. checksum-monitoring
+            # 3. checksum-monitoring
+            if MD5Dir.update_appended_files:
+                self.update_appended_block_lists()
+        finally:
+            if MD5Dir.hash_cache:
+                MD5Dir.hash_cache.close()
+                print(f"run(): {MD5Dir.hash_cache.report()}")
+                MD5Dir.hash_cache = None
     
         
     def zone_transfers_runner(self):
         for transfer in self.zone_transfers_list:
             print(f"    src={transfer["source"]}    dst={transfer["destination"]}") 
             idm = IntegrityDataMover(transfer["source"], transfer["destination"]) 
-            self.transfer_source_to_destination(idm)
+            # the plan is emitted before anything gets copied:
+            planner = TransferPlanner(idm)
+            plan = planner.create_plan()
+            TransferPlanner.print_plan(plan)
+            if self.__dry_run:
+                continue
+            FilesystemMonitoring.raise_on_collisions(plan["collisions"])
+            if not plan["fits"]:
+                print(f"    transfer skipped: not enough space or inodes in {transfer['destination']}")
+                continue
+            start_time = time.time()
+            if self.transfer_source_to_destination(idm):
+                # only complete transfers feed the ETA of later plans
+                planner.record_transfer(plan["bytes"], plan["files"], time.time() - start_time)
 
-    def transfer_source_to_destination(self, idm:IntegrityDataMover):        
-        # Pre-check: Collect existing files/directories in the destination
-        existing_items = idm.collect_existing_items_in_destination()
-        # If any items already exist, print them and report/abort afterwards
+    def zone_w_snapshot_runner(self):
+        # one directory snapshot over all zone W scan roots, walked with the zone W rules
+        roots, rules = self.zone_w_scan_plan
+        if not roots:
+            return
+        snapshot = DirectorySnapshot(logging.getLogger(os.path.basename(__file__)), Path(roots[0]))
+        scanner = ParallelDirectoryScanner.from_config(self.read_monitoring_config())
+        runtime, totalbytes = snapshot.create_snapshot_for_roots(roots, scanner=scanner, rules=rules)
+        snapshot_path = snapshot.save_snapshot()
+        print(f"    zone W snapshot {snapshot_path.name}: {len(roots)} scan roots, {totalbytes:,} bytes in {runtime:.3f} seconds")
+
+    @staticmethod
+    def raise_on_collisions(existing_items:list):
+        # If any items already exist, print them and abort: nothing is copied
         if existing_items:
             print("The following items already exist in the destination:")
             for item in existing_items:
                 print(item)
-            raise FileExistsError("Some items already exist in the destination. No files were copied.")            
+            raise FileExistsError("Some items already exist in the destination. No files were copied.")
+
+    def update_appended_block_lists(self):
+        # grown append-only files in zone S: only the new tail blocks are hashed
+        md5helper = MD5Dir()
+        for zone_s_dir in self.zone_s_list:
+            runtime, updated, rehash = md5helper.update_md5blocks_for_tree(Path(zone_s_dir))
+            print(f"    {zone_s_dir}: {len(updated)} block lists of appended files updated in {runtime:.3f} seconds")
+            for file_path in rehash:
+                print(f"    not append-only, needs a full rehash: {file_path}")
+
+    @staticmethod
+    def read_monitoring_config() -> dict:
+        config_fn = Path.cwd() / "monitoring_config.json"
+        if not config_fn.exists():
+            return {}
+        with open(config_fn, "r", encoding='utf-8') as f:
+            return json.load(f)
+
+    def transfer_source_to_destination(self, idm:IntegrityDataMover) -> bool:
+        """ returns False if the transfer was aborted because of checksum violations (source kept) """
+        # Pre-check: Collect existing files/directories in the destination
+        FilesystemMonitoring.raise_on_collisions(idm.collect_existing_items_in_destination())
         # else: create md5 hashes in sourcepath
-        md5helper = MD5Snapshot()
-        runtime, totalbytes = md5helper.create_md5hashes_for_tree(idm.sourcepath, overwrite=True)
+        md5helper = MD5Dir()
+        source_stats = {}   # (mtime_ns, size) at hashing time: files changed afterwards are not deleted
+        runtime, totalbytes = md5helper.create_md5hashes_for_tree(idm.sourcepath, overwrite=True, file_stats=source_stats)
         print(f"created md5-hashes in source: {idm.sourcepath} in {runtime:.3f} seconds for a total of {totalbytes:,} bytes")
 
         idm.copy_tree()
         #evaluate the checksums after the copy:
-        runtime, fails = md5helper.checksum_validation_for_tree(idm.destpath)
+        verified = set()
+        runtime, fails = md5helper.checksum_validation_for_tree(idm.destpath, verified)
         print(f"Total runtime for checksum_validation in destination after copy: {runtime}")
         if len(fails) > 0:
             print(f"Total checksum violations: {len(fails)}")
             for f, hashes in fails.items():
                 print(f"{str(f).ljust(40, '.')} old={hashes[0]}")
                 print(f"{str(f).ljust(40, '.')} new={hashes[1]}")
-            # TODO: The question is what to do here.. just report or report and abort?
+            # never delete source data after a failed transfer
+            print(f"source {idm.sourcepath} is kept because of the checksum violations")
+            return False
 
-        #if the checksums are ok after copy_tree --> delete source-data
-        idm.remove_source_content_only()
+        #if the checksums are ok after copy_tree --> delete the verified source-data
+        idm.remove_source_content_only(verified, hashed_stats=source_stats)
+        return True
 
     def print_config(self):
         print(f"Zone S directories:")
@@ -77,6 +156,9 @@ class FilesystemMonitoring:
         print(f"Zone w directories:")
         for z in self.zone_w_list:
             print(f"    {z}")
+        print(f"Zone w scan roots:")
+        for root in self.zone_w_scan_plan[0]:
+            print(f"    {root}")
 
         print(f"Zone-Transfer jobs:")
         for t in self.zone_transfers_list:
@@ -85,7 +167,7 @@ class FilesystemMonitoring:
 
 def main():
     print(f"start main() ...")
-    fsmonitor = FilesystemMonitoring()
+    fsmonitor = FilesystemMonitoring(dry_run="--dry-run" in sys.argv)
     #fsmonitor.print_config()
     fsmonitor.run()
 
@@ -0,0 +1,201 @@
+import json
+import logging
+import os
+from pathlib import Path
+import sqlite3
+import threading
+import time
+
+
+class HashCache:
+    """
+        Persistent md5 cache shared by the snapshot, transfer and validation jobs.
+        Entries are keyed on the file identity (st_dev, st_ino) and only used while the stat
+        fingerprint (st_mtime_ns, st_size) is unchanged. Size bounded with LRU eviction.
+
+        Trust policy per purpose ("snapshot", "transfer", "validation"):
+            "trust"  : a matching entry is used if its last real read is younger than max_trust_days
+            "reread" : the file is always read (e.g. bit rot keeps mtime/size) --> the entry gets refreshed
+            "off"    : the cache is neither read nor written
+        The md5 snapshots exist to notice silent changes, so "snapshot" rereads by default.
+
+        Several processes may share the db (WAL, busy timeout); new md5s and last_used updates are
+        buffered in memory and written in one short transaction every COMMIT_INTERVAL writes or
+        COMMIT_SECONDS, so the write lock of the db is never held while a file is hashed.
+        If sqlite still fails (locked, disk full ...) the file is hashed without the cache.
+    """
+
+    DB_FILE = Path.cwd() / "system" / "hash_cache.sqlite"
+    MAX_ENTRIES = 5_000_000
+    MAX_TRUST_DAYS = 30
+    POLICY = {"snapshot": "reread", "transfer": "trust", "validation": "reread"}
+    COMMIT_INTERVAL = 1000   # buffered write operations per commit
+    COMMIT_SECONDS = 10      # ... or seconds since the last commit, whatever comes first
+    TIMEOUT = 30             # seconds to wait for a lock of another process
+
+    def __init__(self, db_file:Path=DB_FILE, max_entries:int=MAX_ENTRIES, max_trust_days:float=MAX_TRUST_DAYS, policy:dict=None):
+        self.log = logging.getLogger(os.path.basename(__file__))
+        self._db_file = Path(db_file)
+        self._max_entries = max_entries
+        self._max_trust_seconds = max_trust_days * 24 * 3600
+        self._policy = dict(HashCache.POLICY, **(policy or {}))
+        for purpose, rule in self._policy.items():
+            if rule not in ["trust", "reread", "off"]:
+                raise ValueError(f"invalid hash cache policy for {purpose}: {rule}")
+        self._lock = threading.Lock()
+        self._pending_rows = {}      # (dev, ino): row of a new md5, not yet written
+        self._pending_touches = {}   # (dev, ino): last_used of a cache hit, not yet written
+        self._last_commit = time.time()
+        self._stats = {"hits": 0, "misses": 0, "rereads": 0, "bytes_saved": 0, "errors": 0}
+        self._db_file.parent.mkdir(parents=True, exist_ok=True)
+        self._con = sqlite3.connect(self._db_file, timeout=HashCache.TIMEOUT, check_same_thread=False)
+        # readers don't block the writer (and vice versa) --> shared by parallel jobs
+        self._con.execute("PRAGMA journal_mode=WAL")
+        self._con.execute("PRAGMA synchronous=NORMAL")
+        self._con.execute("""CREATE TABLE IF NOT EXISTS hashes (
+                                dev INTEGER, ino INTEGER, mtime_ns INTEGER, size INTEGER,
+                                md5 TEXT, verified REAL, last_used REAL,
+                                PRIMARY KEY (dev, ino))""")
+        self._con.execute("CREATE INDEX IF NOT EXISTS hashes_last_used ON hashes (last_used)")
+        self._con.commit()
+
+    @staticmethod
+    def from_config(config:dict) -> 'HashCache':
+        """ returns a HashCache for config["HASH_CACHE"] or None if not configured (or the db can't be opened) """
+        conf = config.get("HASH_CACHE") if config else None
+        if not conf:
+            return None
+        try:
+            return HashCache(Path(conf.get("db_file", HashCache.DB_FILE)), conf.get("max_entries", HashCache.MAX_ENTRIES),
+                             conf.get("max_trust_days", HashCache.MAX_TRUST_DAYS), conf.get("policy"))
+        except sqlite3.OperationalError as e:
+            logging.getLogger(os.path.basename(__file__)).warning(f"hash cache not available, hashing without it: {e}")
+            return None
+
+    @staticmethod
+    def open_from_monitoring_config() -> 'HashCache':
+        config_fn = Path.cwd() / "monitoring_config.json"
+        if not config_fn.exists():
+            return None
+        with open(config_fn, "r", encoding='utf-8') as f:
+            return HashCache.from_config(json.load(f))
+
+    @property
+    def stats(self):
+        return dict(self._stats)
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self._stats["hits"] + self._stats["misses"] + self._stats["rereads"]
+        return self._stats["hits"] / lookups if lookups else 0.0
+
+    def get_md5(self, file_path:Path, purpose:str, create_md5) -> str:
+        """ create_md5: callable which reads the file and returns its md5 (called on a miss) """
+        rule = self._policy.get(purpose, "trust")
+        if rule == "off":
+            return create_md5()
+        st = os.stat(file_path)
+        now = time.time()
+        key = (st.st_dev, st.st_ino)
+        if rule == "trust":
+            with self._lock:
+                try:
+                    row = self._lookup(key, st.st_mtime_ns, st.st_size)
+                except sqlite3.OperationalError as e:
+                    self._count_error(e)
+                    row = None
+                    failed = True
+                else:
+                    failed = False
+                if row and now - row[1] <= self._max_trust_seconds:
+                    if key not in self._pending_rows:
+                        self._pending_touches[key] = now
+                    self._count_write()
+                    self._stats["hits"] += 1
+                    self._stats["bytes_saved"] += st.st_size
+                    return row[0]
+                if not failed:
+                    self._stats["misses"] += 1
+            if failed:
+                return create_md5()     # hashed outside the lock
+        else:
+            with self._lock:
+                self._stats["rereads"] += 1
+
+        md5 = create_md5()
+        # only store it if the file didn't change while it was read
+        st_after = os.stat(file_path)
+        if (st_after.st_mtime_ns, st_after.st_size) == (st.st_mtime_ns, st.st_size):
+            with self._lock:
+                self._pending_rows[key] = (st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size, md5, now, now)
+                self._pending_touches.pop(key, None)
+                self._count_write()
+        return md5
+
+    def _lookup(self, key:tuple, mtime_ns:int, size:int) -> tuple:
+        # called with self._lock held; returns (md5, verified) of a matching entry, the buffered ones first
+        pending = self._pending_rows.get(key)
+        if pending:
+            return (pending[4], pending[5]) if (pending[2], pending[3]) == (mtime_ns, size) else None
+        return self._con.execute("SELECT md5, verified FROM hashes WHERE dev=? AND ino=? AND mtime_ns=? AND size=?",
+                                 (key[0], key[1], mtime_ns, size)).fetchone()
+
+    def _count_write(self):
+        # called with self._lock held; flushes after COMMIT_INTERVAL buffered writes or COMMIT_SECONDS
+        if (len(self._pending_rows) + len(self._pending_touches) >= HashCache.COMMIT_INTERVAL
+                or time.time() - self._last_commit >= HashCache.COMMIT_SECONDS):
+            self._flush()
+
+    def _flush(self):
+        # called with self._lock held; one short write transaction for all buffered rows
+        try:
+            if self._pending_rows:
+                self._con.executemany("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?)", self._pending_rows.values())
+            if self._pending_touches:
+                self._con.executemany("UPDATE hashes SET last_used=? WHERE dev=? AND ino=?",
+                                      [(last_used, dev, ino) for (dev, ino), last_used in self._pending_touches.items()])
+            self._con.commit()
+        except sqlite3.OperationalError as e:
+            self._count_error(e)    # the md5s are fine, they just aren't cached
+        self._pending_rows = {}
+        self._pending_touches = {}
+        self._last_commit = time.time()
+
+    def _count_error(self, error:sqlite3.OperationalError):
+        # called with self._lock held
+        self._stats["errors"] += 1
+        if self._stats["errors"] <= 10:
+            self.log.warning(f"hash cache error, hashing without the cache: {error}")
+        try:
+            self._con.rollback()    # don't keep a half written transaction (and its lock)
+        except sqlite3.OperationalError:
+            pass
+
+    def evict(self) -> int:
+        """ removes the least recently used entries above max_entries """
+        with self._lock:
+            self._flush()
+            try:
+                count = self._con.execute("SELECT COUNT(*) FROM hashes").fetchone()[0]
+                excess = count - self._max_entries
+                if excess <= 0:
+                    return 0
+                self._con.execute("DELETE FROM hashes WHERE rowid IN (SELECT rowid FROM hashes ORDER BY last_used LIMIT ?)", (excess,))
+                self._con.commit()
+            except sqlite3.OperationalError as e:
+                self._count_error(e)
+                return 0
+        self.log.info(f"hash cache: evicted {excess:,} least recently used entries")
+        return excess
+
+    def report(self) -> str:
+        s = self._stats
+        return (f"hash cache: hit rate {self.hit_rate:.1%} ({s['hits']:,} hits, {s['misses']:,} misses, "
+                f"{s['rereads']:,} forced rereads), {s['bytes_saved']:,} bytes not read, {s['errors']:,} db errors")
+
+    def close(self):
+        self.evict()
+        with self._lock:
+            self._flush()
+            self._con.close()
+        self.log.info(self.report())
@@ -0,0 +1,263 @@
+import hashlib
+import json
+import logging
+import logging.config
+import os
+from pathlib import Path
+import random
+import time
+
+from md5dir import MD5Dir
+
+
+class IntegrityAudit:
+    """
+        Daily sampling audit instead of a full checksum_validation_for_tree:
+        - units (sampling and state) are files (.md5_hashes.txt); a randomly sampled file with a
+          per-block hash list (.md5_hashes_blocks.json) only gets SAMPLE_BLOCKS random blocks read
+          --> partial-block verification, the block lists are only loaded for the selected files
+        - each run checks about total/runs_per_rotation bytes: a part of the budget goes to the units
+          verified longest ago (oldest first), the rest is a random sample weighted by bytes and by
+          time since the last verification
+        - units not verified within the rotation period (and the oldest ones) are checked completely
+          --> the whole archive is covered once per rotation period
+        - new units get a first_seen staggered over one rotation (derived from the key), so a new
+          archive does not become overdue all at once
+        - the state (last verification per unit) is kept between runs in system/audit_state-<id>.json
+    """
+
+    STATE_DIR = Path.cwd() / "system"
+    ROTATION_DAYS = 30
+    RUNS_PER_DAY = 1
+    CONFIDENCE = 0.95
+    TOLERABLE_CORRUPTION_RATE = 0.001
+    OLDEST_FIRST_SHARE = 0.5    # of the budget of a run
+    SAMPLE_BLOCKS = 4           # random blocks read of a sampled file with a block list
+
+    def __init__(self, rootdir:Path, rotation_days:float=ROTATION_DAYS, runs_per_day:float=RUNS_PER_DAY,
+                 confidence:float=CONFIDENCE, tolerable_corruption_rate:float=TOLERABLE_CORRUPTION_RATE):
+        self.log = logging.getLogger(os.path.basename(__file__))
+        self._rootdir = Path(rootdir)
+        self._rotation_seconds = rotation_days * 24 * 3600
+        self._runs_per_rotation = max(1.0, rotation_days * runs_per_day)
+        self._confidence = confidence
+        self._tolerable_corruption_rate = tolerable_corruption_rate
+        self._md5dir = MD5Dir()
+        root_id = hashlib.md5(self._rootdir.as_posix().encode("utf-8")).hexdigest()[:8]
+        self._state_file = IntegrityAudit.STATE_DIR / f"audit_state-{root_id}.json"
+        self._state = self.load_state()
+
+    @staticmethod
+    def from_config(rootdir:Path, config:dict) -> 'IntegrityAudit':
+        conf = config.get("AUDIT", {}) if config else {}
+        return IntegrityAudit(rootdir, conf.get("rotation_days", IntegrityAudit.ROTATION_DAYS),
+                              conf.get("runs_per_day", IntegrityAudit.RUNS_PER_DAY),
+                              conf.get("confidence", IntegrityAudit.CONFIDENCE),
+                              conf.get("tolerable_corruption_rate", IntegrityAudit.TOLERABLE_CORRUPTION_RATE))
+
+    #region state
+    def load_state(self) -> dict:
+        if self._state_file.exists():
+            with open(self._state_file, "r", encoding='utf-8') as f:
+                return json.load(f)
+        return {"rootdir": self._rootdir.as_posix(), "units": {}, "runs": []}
+
+    def save_state(self):
+        self._state_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = Path(f"{self._state_file}.tmp")
+        with open(tmp_path, "w", encoding='utf-8') as f:
+            json.dump(self._state, f, ensure_ascii=False)
+        os.replace(tmp_path, self._state_file)
+    #endregion state
+
+    def get_stagger(self, key:str) -> float:
+        """ deterministic offset in [0, rotation) for a new unit """
+        fraction = int(hashlib.md5(key.encode("utf-8")).hexdigest()[:8], 16) / 0x1_0000_0000
+        return fraction * self._rotation_seconds
+
+    def collect_units(self) -> list:
+        """
+            returns the list of units: {"key", "path", "md5", "length", "blocks"}
+            blocks: True if the stored block list still matches the file size (the list itself is not kept)
+        """
+        units = []
+        for curdir, _, _ in os.walk(self._rootdir):
+            dir_path = Path(curdir)
+            expected_hashes = self._md5dir.get_dict_from_md5hashes_file(dir_path / MD5Dir.MD5HASHES_FILENAME)
+            block_hashes = self._md5dir.get_dict_from_md5blocks_file(dir_path / MD5Dir.MD5BLOCKS_FILENAME)
+            for file_name, expected_md5 in expected_hashes.items():
+                file_path = dir_path / file_name
+                size = file_path.stat().st_size if file_path.exists() else 0
+                entry = block_hashes.get(file_name)
+                units.append({"key": file_path.relative_to(self._rootdir).as_posix(), "path": file_path, "md5": expected_md5,
+                              "length": size, "blocks": bool(entry and entry["size"] == size and len(entry["blocks"]) > 1)})
+        return units
+
+    def select_sample(self, units:list, now:float) -> tuple:
+        """
+            returns (selected_units, overdue_count): overdue units first, then the oldest units
+            up to OLDEST_FIRST_SHARE of the budget, then a weighted random sample.
+            unit["full"]: the whole file is verified (coverage); False: random blocks only
+        """
+        unit_states = self._state["units"]
+        total_bytes = sum(unit["length"] for unit in units)
+        budget = total_bytes / self._runs_per_rotation
+
+        overdue, others = [], []
+        for unit in units:
+            unit["full"] = True
+            # unit state: [first_seen, last_verified] --> new units are due within one rotation, staggered
+            first_seen, last_verified = unit_states.setdefault(unit["key"], [now - self.get_stagger(unit["key"]), None])
+            age = now - (last_verified if last_verified else first_seen)
+            if age >= self._rotation_seconds or unit["length"] == 0:   # empty or missing files cost nothing
+                overdue.append(unit)
+            else:
+                others.append((age, unit))
+        selected = list(overdue)
+        used = sum(unit["length"] for unit in overdue)
+
+        # oldest first: the units which would become overdue next are checked before they pile up
+        others.sort(key=lambda item: item[0], reverse=True)
+        oldest_budget = budget * IntegrityAudit.OLDEST_FIRST_SHARE
+        nrof_oldest = 0
+        for _, unit in others:
+            if used >= oldest_budget:
+                break
+            selected.append(unit)
+            used += unit["length"]
+            nrof_oldest += 1
+
+        # weighted sampling without replacement (Efraimidis/Spirakis): key = u^(1/w)
+        sample = [(random.random() ** (1 / (unit["length"] * (1 + age / self._rotation_seconds))), unit)
+                  for age, unit in others[nrof_oldest:]]
+        for _, unit in sorted(sample, key=lambda item: item[0], reverse=True):
+            if used >= budget:
+                break
+            selected.append(unit)
+            if unit["blocks"]:
+                unit["full"] = False
+                used += min(unit["length"], IntegrityAudit.SAMPLE_BLOCKS * MD5Dir.BLOCK_SIZE)
+            else:
+                used += unit["length"]
+        return (selected, len(overdue))
+
+    def get_block_entry(self, unit:dict) -> dict:
+        """ block list of the unit's file (loaded only for selected units), None if it doesn't match anymore """
+        block_hashes = self._md5dir.get_dict_from_md5blocks_file(unit["path"].parent / MD5Dir.MD5BLOCKS_FILENAME)
+        entry = block_hashes.get(unit["path"].name)
+        if entry and entry["size"] == unit["path"].stat().st_size:
+            return entry
+        return None
+
+    def verify_unit(self, unit:dict) -> tuple:
+        """ returns (bytes read, None) if ok, else (bytes read, (actual md5 or 'missing'/'corrupted', byte ranges)) """
+        if not unit["path"].exists():
+            return (0, ("missing", "whole file"))
+        entry = self.get_block_entry(unit) if unit["blocks"] else None
+        if entry is None:
+            actual_md5 = MD5Dir.get_md5(unit["path"], "validation")
+            return (unit["length"], None if actual_md5 == unit["md5"] else (actual_md5, "whole file"))
+
+        block_size = entry["block_size"]
+        if unit["full"]:
+            bad_ranges = MD5Dir.get_corrupted_byte_ranges(unit["path"], entry)
+            nrof_bytes = unit["length"]
+        else:
+            # partial-block verification: a few random blocks of the file
+            indexes = sorted(random.sample(range(len(entry["blocks"])), min(IntegrityAudit.SAMPLE_BLOCKS, len(entry["blocks"]))))
+            bad_ranges, nrof_bytes = [], 0
+            for i in indexes:
+                block = MD5Dir.read_block(unit["path"], i, block_size)
+                nrof_bytes += len(block)
+                if hashlib.md5(block).hexdigest() != entry["blocks"][i]:
+                    bad_ranges.append((i * block_size, i * block_size + len(block) - 1))
+        if not bad_ranges:
+            return (nrof_bytes, None)
+        return (nrof_bytes, ("corrupted", ", ".join(f"bytes {start:,}-{end:,}" for start, end in bad_ranges)))
+
+    def get_confidence(self, nrof_checked:int) -> tuple:
+        """
+            with 0 failures in n checked units:
+            - confidence that the corruption rate is below the tolerable rate: 1 - (1 - p)^n
+            - upper bound of the corruption rate at the configured confidence: 1 - (1 - C)^(1/n)
+            (the sample is weighted, so this is an approximation for uniformly spread rot)
+        """
+        if nrof_checked == 0:
+            return (0.0, 1.0)
+        reached = 1 - (1 - self._tolerable_corruption_rate) ** nrof_checked
+        upper_bound = 1 - (1 - self._confidence) ** (1 / nrof_checked)
+        return (reached, upper_bound)
+
+    def run(self) -> dict:
+        start_time = time.time()
+        now = time.time()
+        units = self.collect_units()
+        selected, nrof_overdue = self.select_sample(units, now)
+
+        failures = {}
+        verified_bytes = 0
+        nrof_partial = 0
+        for unit in selected:
+            nrof_bytes, failure = self.verify_unit(unit)
+            verified_bytes += nrof_bytes
+            if failure is None:
+                if unit["full"]:
+                    self._state["units"][unit["key"]][1] = now  # only complete checks count for the rotation
+                else:
+                    nrof_partial += 1
+                continue
+            actual, byte_range = failure
+            failures[unit["key"]] = (unit["md5"], actual, byte_range)
+            print(f"Checksum mismatch for '{unit['path']}' ({byte_range}): expected {unit['md5']}, got {actual}")
+
+        # forget units which don't exist anymore
+        unit_keys = {unit["key"] for unit in units}
+        self._state["units"] = {key: state for key, state in self._state["units"].items() if key in unit_keys}
+
+        total_bytes = sum(unit["length"] for unit in units)
+        covered_bytes = 0
+        for unit in units:
+            last_verified = self._state["units"][unit["key"]][1]
+            if last_verified and now - last_verified < self._rotation_seconds:
+                covered_bytes += unit["length"]
+        confidence_reached, corruption_upper_bound = self.get_confidence(len(selected) - len(failures))
+        report = {"time": now,
+                  "units": len(units),
+                  "checked": len(selected),
+                  "partially_checked": nrof_partial,
+                  "overdue": nrof_overdue,
+                  "failures": len(failures),
+                  "verified_bytes": verified_bytes,
+                  "total_bytes": total_bytes,
+                  "rotation_coverage": covered_bytes / total_bytes if total_bytes else 1.0,
+                  "confidence_reached": confidence_reached if not failures else 0.0,
+                  "corruption_rate_upper_bound": corruption_upper_bound if not failures else None,
+                  "runtime": time.time() - start_time}
+        self._state["runs"] = (self._state["runs"] + [report])[-100:]
+        self.save_state()
+
+        self.log.info(f"audit {self._rootdir}: checked {len(selected)} of {len(units)} units "
+                      f"({verified_bytes:,} of {total_bytes:,} bytes), {len(failures)} failures")
+        if not failures:
+            self.log.info(f"confidence {confidence_reached:.1%} that less than {self._tolerable_corruption_rate:.2%} "
+                          f"of the units are corrupted ({self._confidence:.0%}-bound: {corruption_upper_bound:.3%})")
+        report["failure_list"] = failures
+        return report
+
+
+def main():
+    with open("logging.json", "r") as f:
+        log_config = json.load(f)
+        logging.config.dictConfig(log_config)
+    log = logging.getLogger(os.path.basename(__file__))
+
+    log.info("main(): start ...")
+    with open(Path.cwd() / "monitoring_config.json", "r", encoding='utf-8') as f:
+        config = json.load(f)
+    src = r"C:\tmp\testsrc"
+    report = IntegrityAudit.from_config(Path(src), config).run()
+    log.info(f"rotation coverage: {report['rotation_coverage']:.1%}, runtime {report['runtime']:.3f} seconds")
+    log.info("main(): all done")
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,20 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import json
 import os
 from pathlib import Path
 import shutil
-from md5_snapshot import MD5Snapshot 
+import threading
+import time
+from md5dir import MD5Dir
 
 class IntegrityDataMover:
 
+    REPORT_DIR = Path.cwd() / "system" / "reports"
+    REMOVE_WORKERS = 8
+
     def __init__(self, src:str, dest:str):
-        self._md5helper = MD5Snapshot()
+        self._md5helper = MD5Dir()
         self._md5list_filename = "md5_hashes.txt"
 
         self._sourcepath = Path(src)
@@ -46,18 +54,111 @@ class IntegrityDataMover:
             else:
                 shutil.copy2(item, dest_item)
 
-    def remove_source_content_only(self):
-        # removing directory-structure        
-        for filename in os.listdir(self.sourcepath): 
-            tmp_path = self.sourcepath / filename  
-            try:
-                if tmp_path.is_file():
-                    os.remove(tmp_path)  
-                else:  
-                    shutil.rmtree(tmp_path)
-            except Exception as e:  
-                print(f"Error deleting {tmp_path}: {e}")
-        print("remove_source() done")        
+    def remove_source_content_only(self, verified:set, workers=REMOVE_WORKERS, hashed_stats:dict=None) -> dict:
+        """
+            Deletes only source files whose destination md5 was verified (verified: paths relative
+            to the source, posix style). Directories are processed level by level in parallel,
+            files are removed with unlink(name, dir_fd=...) --> one path resolution per directory.
+            hashed_stats: {rel_path: (st_mtime_ns, st_size)} at source hashing time (see
+            MD5Dir.create_md5hashes_for_tree) --> files changed since then are kept.
+            Directories which still contain unverified files are kept; errors are counted per
+            entry/directory, the removal goes on.
+            A manifest of the removed files (+ summary with throughput) goes to system/reports/.
+        """
+        start_time = time.time()
+        use_dir_fd = os.unlink in os.supports_dir_fd and os.scandir in os.supports_fd
+        manifest_path = IntegrityDataMover.REPORT_DIR / f"removal-{datetime.now():%Y%m%d-%H%M%S}.jsonl"
+        IntegrityDataMover.REPORT_DIR.mkdir(parents=True, exist_ok=True)
+        stats = {"files": 0, "bytes": 0, "kept_files": 0, "changed_files": 0, "removed_dirs": 0, "errors": 0}
+        lock = threading.Lock()
+        all_dirs = []
+
+        with open(manifest_path, "w", encoding='utf-8') as manifest:
+            def remove_files_in_dir(rel_dir:str) -> list:
+                dir_path = self.sourcepath / rel_dir if rel_dir else self.sourcepath
+                removed, subdirs, kept, changed, errors, sidecars = [], [], 0, 0, 0, []
+                fd = None
+                try:
+                    try:
+                        if use_dir_fd:
+                            fd = os.open(dir_path, os.O_RDONLY)
+                        with os.scandir(fd if use_dir_fd else dir_path) as it:
+                            entries = list(it)
+                    except OSError as e:
+                        print(f"Error listing {dir_path}: {e}")
+                        entries = []
+                        errors += 1
+                    for entry in entries:
+                        rel_path = f"{rel_dir}/{entry.name}" if rel_dir else entry.name
+                        try:
+                            if entry.is_dir(follow_symlinks=False):
+                                subdirs.append(rel_path)
+                            elif MD5Dir.is_md5_sidecar(entry.name):
+                                sidecars.append(entry.name)
+                            elif rel_path in verified:
+                                st = entry.stat()
+                                if hashed_stats is not None and hashed_stats.get(rel_path) != (st.st_mtime_ns, st.st_size):
+                                    # modified after hashing: the verified copy is not this content
+                                    print(f"Changed since hashing, kept: {dir_path / entry.name}")
+                                    kept += 1
+                                    changed += 1
+                                    continue
+                                if use_dir_fd:
+                                    os.unlink(entry.name, dir_fd=fd)
+                                else:
+                                    os.remove(dir_path / entry.name)
+                                removed.append((rel_path, st.st_size))
+                            else:
+                                kept += 1
+                        except OSError as e:
+                            print(f"Error deleting {dir_path / entry.name}: {e}")
+                            kept += 1
+                            errors += 1
+                    # the md5 sidecars only go when nothing else is left in the directory
+                    if kept == 0 and errors == 0:
+                        for name in sidecars:
+                            try:
+                                if use_dir_fd:
+                                    os.unlink(name, dir_fd=fd)
+                                else:
+                                    os.remove(dir_path / name)
+                            except OSError as e:
+                                print(f"Error deleting {dir_path / name}: {e}")
+                                errors += 1
+                finally:
+                    if fd is not None:
+                        os.close(fd)
+                with lock:
+                    for rel_path, size in removed:
+                        manifest.write(json.dumps({"path": rel_path, "bytes": size}, ensure_ascii=False) + "\n")
+                    stats["files"] += len(removed)
+                    stats["bytes"] += sum(size for _, size in removed)
+                    stats["kept_files"] += kept
+                    stats["changed_files"] += changed
+                    stats["errors"] += errors
+                return subdirs
+
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                level = [""]
+                while level:
+                    all_dirs.extend(level)
+                    level = [subdir for subdirs in executor.map(remove_files_in_dir, level) for subdir in subdirs]
+
+            # empty directories bottom up (the source root itself stays)
+            for rel_dir in reversed(all_dirs[1:]):
+                try:
+                    os.rmdir(self.sourcepath / rel_dir)
+                    stats["removed_dirs"] += 1
+                except OSError:
+                    pass    # not empty: contains unverified files
+
+            stats["seconds"] = time.time() - start_time
+            stats["mb_per_second"] = stats["bytes"] / 1_000_000 / stats["seconds"] if stats["seconds"] > 0 else 0.0
+            manifest.write(json.dumps({"summary": stats}) + "\n")
+        print(f"remove_source() done: {stats['files']:,} files ({stats['bytes']:,} bytes) removed, "
+              f"{stats['kept_files']:,} unverified or changed files kept, {stats['errors']:,} errors, "
+              f"{stats['mb_per_second']:.1f} MB/s, manifest: {manifest_path}")
+        return stats
         
     def collect_existing_items_in_destination(self): 
         # Pre-check: Collect existing files/directories in the destination
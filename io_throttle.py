@@ -0,0 +1,231 @@
+import ctypes
+from datetime import datetime, timedelta
+import logging
+import os
+import platform
+import threading
+import time
+
+
+class TokenBucket:
+    """ Thread safe token bucket: consume() blocks until enough tokens are available. """
+
+    def __init__(self, rate:float, capacity:float=None):
+        self._rate = rate
+        self._capacity = capacity if capacity else rate
+        self._tokens = self._capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    @property
+    def rate(self):
+        return self._rate
+    @rate.setter
+    def rate(self, newval:float):
+        with self._lock:
+            self._rate = newval
+
+    def consume(self, amount:float):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self._capacity, self._tokens + (now - self._last) * self._rate)
+                self._last = now
+                # a request bigger than the bucket is allowed as soon as the bucket is full
+                needed = min(amount, self._capacity)
+                if self._tokens >= needed:
+                    self._tokens -= amount
+                    return
+                wait = (needed - self._tokens) / self._rate
+            time.sleep(wait)
+
+
+class HashingWindowClosed(Exception):
+    """ raised by IOThrottle.read() outside of the time windows if outside_window is "exit" """
+
+
+class IOThrottle:
+    """
+        Low priority background reading for the hashing jobs:
+        - token buckets for read bandwidth (bytes/s) and IOPS
+        - adaptive backoff when the observed read latency rises above the target
+        - nice/ioprio for the reading (worker-)threads
+        - time windows in which reading is allowed at all
+        Configured in monitoring_config.json under "HASHING_THROTTLE".
+    """
+
+    IOPRIO_CLASSES = {"realtime": 1, "best-effort": 2, "idle": 3}
+    IOPRIO_SET_SYSCALL = {"x86_64": 251, "i386": 289, "i686": 289, "aarch64": 30, "armv7l": 314, "ppc64le": 273, "s390x": 282}
+    READ_SIZE = 1024 * 1024
+    MIN_FACTOR = 0.05   # adaptive backoff never goes below 5% duty cycle
+    WINDOW_CHECK_INTERVAL = 10  # seconds between two time window checks while reading
+
+    def __init__(self, max_bytes_per_sec:int=0, max_iops:int=0, latency_target_ms:float=0,
+                 nice:int=None, ioprio_class:str=None, windows:list=None, outside_window:str="sleep"):
+        self.log = logging.getLogger(os.path.basename(__file__))
+        self._bytes_bucket = TokenBucket(max_bytes_per_sec, max(max_bytes_per_sec, IOThrottle.READ_SIZE)) if max_bytes_per_sec > 0 else None
+        self._iops_bucket = TokenBucket(max_iops) if max_iops > 0 else None
+        self._latency_target = latency_target_ms / 1000
+        self._latency_ewma = 0.0
+        self._factor = 1.0
+        self._nice = nice
+        self._ioprio_class = ioprio_class
+        if ioprio_class is not None and ioprio_class not in IOThrottle.IOPRIO_CLASSES:
+            raise ValueError(f"invalid ioprio_class: {ioprio_class}")
+        self._windows = [(IOThrottle.parse_time(start), IOThrottle.parse_time(end)) for start, end in (windows or [])]
+        if outside_window not in ["sleep", "exit"]:
+            raise ValueError(f"invalid outside_window: {outside_window}")
+        self._outside_window = outside_window
+        self._next_window_check = 0.0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def from_config(config:dict):
+        """ returns an IOThrottle for config["HASHING_THROTTLE"] or None if not configured """
+        conf = config.get("HASHING_THROTTLE") if config else None
+        if not conf:
+            return None
+        return IOThrottle(conf.get("max_bytes_per_sec", 0), conf.get("max_iops", 0), conf.get("latency_target_ms", 0),
+                          conf.get("nice"), conf.get("ioprio_class"), conf.get("windows"), conf.get("outside_window", "sleep"))
+
+    @staticmethod
+    def parse_time(hh_mm:str) -> int:
+        hours, minutes = hh_mm.split(":")
+        return int(hours) * 60 + int(minutes)
+
+    #region properties
+    @property
+    def read_size(self):
+        return IOThrottle.READ_SIZE
+
+    @property
+    def factor(self):
+        return self._factor
+
+    @property
+    def exit_outside_window(self):
+        return self._outside_window == "exit"
+    #endregion properties
+
+    #region thread priority
+    def apply_thread_priority(self):
+        """ sets nice and ioprio for the calling thread (linux: per thread, elsewhere: best effort) """
+        tid = threading.get_native_id()
+        if self._nice is not None and hasattr(os, "setpriority"):
+            try:
+                os.setpriority(os.PRIO_PROCESS, tid, self._nice)
+            except OSError as e:
+                self.log.warning(f"could not set nice={self._nice} for thread {tid}: {e}")
+        if self._ioprio_class is not None:
+            self.set_ioprio(tid, IOThrottle.IOPRIO_CLASSES[self._ioprio_class])
+
+    def run_in_thread(self, func, *args):
+        """
+            runs func(*args) in a dedicated worker thread with nice/ioprio applied and returns its result
+            (exceptions are re-raised) --> the calling thread keeps its priority
+        """
+        result = {}
+        def worker():
+            self.apply_thread_priority()
+            try:
+                result["value"] = func(*args)
+            except BaseException as e:
+                result["error"] = e
+        thread = threading.Thread(target=worker, name="throttled-hashing")
+        thread.start()
+        thread.join()
+        if "error" in result:
+            raise result["error"]
+        return result["value"]
+
+    def set_ioprio(self, tid:int, ioprio_class:int, ioprio_data:int=7):
+        syscall_nr = IOThrottle.IOPRIO_SET_SYSCALL.get(platform.machine())
+        if platform.system() != "Linux" or syscall_nr is None:
+            self.log.info(f"ioprio not supported on {platform.system()}/{platform.machine()}")
+            return
+        IOPRIO_WHO_PROCESS = 1
+        ioprio = (ioprio_class << 13) | (0 if ioprio_class == 3 else ioprio_data)
+        libc = ctypes.CDLL(None, use_errno=True)
+        if libc.syscall(syscall_nr, IOPRIO_WHO_PROCESS, tid, ioprio) != 0:
+            self.log.warning(f"could not set ioprio class={ioprio_class} for thread {tid}: {os.strerror(ctypes.get_errno())}")
+    #endregion thread priority
+
+    #region time windows
+    def in_window(self, now:datetime=None) -> bool:
+        if not self._windows:
+            return True
+        now = now if now else datetime.now()
+        minute = now.hour * 60 + now.minute
+        for start, end in self._windows:
+            if start <= end and start <= minute < end:
+                return True
+            if start > end and (minute >= start or minute < end):  # e.g. 22:00 - 06:00
+                return True
+        return False
+
+    def seconds_until_window(self, now:datetime=None) -> float:
+        now = now if now else datetime.now()
+        if self.in_window(now):
+            return 0
+        candidates = []
+        for start, _ in self._windows:
+            start_dt = now.replace(hour=start // 60, minute=start % 60, second=0, microsecond=0)
+            if start_dt <= now:
+                start_dt += timedelta(days=1)
+            candidates.append((start_dt - now).total_seconds())
+        return min(candidates)
+
+    def wait_for_window(self):
+        wait = self.seconds_until_window()
+        if wait > 0:
+            self.log.info(f"outside of the hashing time windows --> paused for {wait:.0f} seconds")
+            time.sleep(wait)
+
+    def check_window(self):
+        """ outside of the time windows: sleep until the next one starts or raise HashingWindowClosed ("exit") """
+        if not self._windows:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if now < self._next_window_check:
+                return
+            self._next_window_check = now + IOThrottle.WINDOW_CHECK_INTERVAL
+        if self.in_window():
+            return
+        if self.exit_outside_window:
+            raise HashingWindowClosed("outside of the hashing time windows")
+        self.wait_for_window()
+        with self._lock:
+            self._next_window_check = time.monotonic() + IOThrottle.WINDOW_CHECK_INTERVAL
+    #endregion time windows
+
+    #region reading
+    def before_read(self, nbytes:int):
+        if self._iops_bucket:
+            self._iops_bucket.consume(1)
+        if self._bytes_bucket:
+            self._bytes_bucket.consume(nbytes)
+
+    def after_read(self, latency:float):
+        if self._latency_target <= 0:
+            return
+        with self._lock:
+            self._latency_ewma = 0.8 * self._latency_ewma + 0.2 * latency
+            if self._latency_ewma > self._latency_target:
+                self._factor = max(IOThrottle.MIN_FACTOR, self._factor * 0.7)
+            elif self._latency_ewma < self._latency_target / 2:
+                self._factor = min(1.0, self._factor * 1.05)
+            factor = self._factor
+        if factor < 1.0:
+            # duty cycle: after a read of <latency> seconds stay idle for the remaining share
+            time.sleep(latency * (1 / factor - 1))
+
+    def read(self, f, size:int=None) -> bytes:
+        size = size if size else IOThrottle.READ_SIZE
+        self.check_window()     # also in the middle of a large file
+        self.before_read(size)
+        start = time.monotonic()
+        data = f.read(size)
+        self.after_read(time.monotonic() - start)
+        return data
+    #endregion reading
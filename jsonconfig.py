@@ -46,7 +46,13 @@ class JsonConfig:
     @staticmethod
     def init_default_zone_w_config():
         zone_w_conf = JsonConfig("zone_w_config.json")
-        conf = {"directories" : [r"*"]}
+        conf = {"directories" : [r"*"],
+                "rules" : {"excludes" : ["$RECYCLE.BIN/", "System Volume Information/", "__pycache__/", "node_modules/",
+                                         ".cache/", "*.tmp", "~$*", "Thumbs.db"],
+                           "max_file_size" : 0,
+                           "max_age_days" : 0,
+                           "min_age_seconds" : 0,
+                           "stay_on_mount" : True}}
         zone_w_conf.data = conf
         zone_w_conf.writejson()        
 
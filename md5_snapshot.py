@@ -5,7 +5,10 @@ import os
 from pathlib import Path
 import time
 
+from hash_cache import HashCache
+from io_throttle import HashingWindowClosed, IOThrottle
 from md5dir import MD5Dir
+from scan_rules import ScanRules
 from snapshot import Snapshot
 
 class MD5Snapshot (Snapshot):
@@ -19,32 +22,70 @@ class MD5Snapshot (Snapshot):
     def __init__(self, log:logging.Logger):
         Snapshot.__init__(self, "-md5.json")
 
-        config = Snapshot.readjson_config()
+        config = self.readjson_config()
         if config and "SNAPSHOT_HYSTORY_DIR" in config :
-            Snapshot.HYSTORY_DIR = config["SNAPSHOT_HYSTORY_DIR"]
+            Snapshot.HYSTORY_DIR = Path(config["SNAPSHOT_HYSTORY_DIR"])
             self.log.info(f"monitoring_config.json: set HYSTORY_DIR={Snapshot.HYSTORY_DIR}")
         else:
             Snapshot.HYSTORY_DIR = Path.cwd() / "system" / "directorystructure_snapshots"
 
         self.log = log
+        self._snapshot.setdefault("files", {})
         if self.status != "INIT":
-            self.nroffiles = Snapshot.get_nroffiles_from_snapshot()
-            self.totalbytes = Snapshot.get_totalbytes_from_snapshot()
-            self.runtime = Snapshot.get_runtime_from_snapshot()
+            self.nroffiles = self.get_nroffiles_from_snapshot()
+            self.totalbytes = self.get_totalbytes_from_snapshot()
+            self.runtime = self.get_runtime_from_snapshot()
+
+    @property
+    def snapshot(self):
+        return self._snapshot
+
+    @property
+    def snapshot_in_progress_file_path(self) -> Path:
+        # the checkpoint lives next to the md5 history, independent of Snapshot.HYSTORY_DIR
+        return MD5Snapshot.SNAPSHOT_IN_PROGRESS_FILE_PATH
               
     
-    def create_md5_snapshot(self, rootdir:Path) -> tuple:
+    def get_md5_hashes_for_subtree(self, dir_path:Path, number:int=None) -> dict:
+        # reads only the entries of dir_path and below (default: last snapshot of the history)
+        reader = self.get_snapshot_reader(MD5Snapshot.SNAPSHOT_HYSTORY_DIR, number)
+        return dict(reader.iter_elements(Path(dir_path).as_posix()))
+
+    def create_md5_snapshot(self, rootdir:Path, throttle:IOThrottle=None, block_mode=None, rules:ScanRules=None) -> Path:
+        """
+            returns the saved history file, None if stopped outside of the hashing time windows (resumable)
+            block_mode: default MD5Dir.block_mode ("BLOCK_MODE" of monitoring_config.json)
+        """
+        block_mode = MD5Dir.block_mode if block_mode is None else block_mode
+        self.create_md5_snapshot_files(rootdir, rules)
+        if throttle is None:
+            return self.hash_snapshot_files(None, block_mode)
+        # nice/ioprio only for a dedicated hashing thread, the caller keeps its priority
+        return throttle.run_in_thread(self.hash_snapshot_files, throttle, block_mode)
+
+    def hash_snapshot_files(self, throttle:IOThrottle=None, block_mode=False) -> Path:
         start_time = time.time()   
-        self.create_md5_snapshot_files(rootdir)
         tmp_byte_count = 0
         for file_name, md5 in self._snapshot["files"].items():            
             if md5 != "xxx":
                 continue    # already done in a previous run
             file_path = Path(file_name)
+            try:
+                if block_mode and file_path.stat().st_size >= MD5Dir.BLOCK_MODE_MIN_FILE_SIZE:
+                    # per-block md5 list for large files (localized corruption reports, partial rehash)
+                    md5_val, block_entry = MD5Dir.create_md5_and_blocks_from_file(file_path, throttle=throttle)
+                    self._snapshot.setdefault("blocks", {})[file_name] = block_entry
+                else:
+                    md5_val = MD5Dir.get_md5(file_path, "snapshot", throttle=throttle)
+            except HashingWindowClosed:
+                # pause (also in the middle of a file): checkpoint, the next run resumes from IN_PROGRESS
+                self._runtime = self._runtime + (time.time() - start_time)
+                self.update_file_infos("IN_PROGRESS")
+                self.log.info(f"outside of the hashing time windows --> stopped, resume from {self._snapshot['file_name']}")
+                return None
             tmp_byte_count += file_path.stat().st_size
             self.totalbytes += file_path.stat().st_size
             self.nroffiles += 1
-            md5_val = MD5Dir.create_md5_from_file(file_path)
             self._snapshot["files"][file_name] = md5_val             
             if tmp_byte_count >= MD5Snapshot.PROGRESS_STEP_SIZE:
                 self.update_file_infos("IN_PROGRESS")
@@ -54,28 +95,40 @@ class MD5Snapshot (Snapshot):
                 tmp_byte_count = 0
                 start_time = time.time() 
         # end for-loop
-        dest = MD5Snapshot.SNAPSHOT_HYSTORY_DIR / self.create_new_snapshot_filename()
+        self._runtime = self._runtime + (time.time() - start_time)
+        return self.finish_md5_snapshot()
+
+    def finish_md5_snapshot(self) -> Path:
+        # no full write of the in-progress file, it is deleted below
+        self.update_file_infos("DONE", save=False)
+        # the finished snapshot goes into the history as base or compressed delta (file_name: the history file)
+        store = self.get_snapshot_store(MD5Snapshot.SNAPSHOT_HYSTORY_DIR)
+        dest = store.save(store.get_last_snapshot_number() + 1, self._snapshot)
         self._snapshot["file_name"] = dest.as_posix()
-        self.update_file_infos("DONE")
+        self.log.info(f"md5 snapshot saved: {dest}")
   
         if os.path.exists(MD5Snapshot.SNAPSHOT_IN_PROGRESS_FILE_PATH): 
             os.remove(MD5Snapshot.SNAPSHOT_IN_PROGRESS_FILE_PATH)
             print(f"In-Progress-File '{MD5Snapshot.SNAPSHOT_IN_PROGRESS_FILE_PATH}' deleted successfully.")
         else: 
             print(f"File '{MD5Snapshot.SNAPSHOT_IN_PROGRESS_FILE_PATH}' not found.")
+        return dest
     
-    def create_md5_snapshot_files(self, rootdir: Path):  
+    def create_md5_snapshot_files(self, rootdir: Path, rules:ScanRules=None):  
         if self.status in ["FILE_LIST", "IN_PROGRESS", "DONE"]:
             return
                 
-        for dir, _, files in os.walk(rootdir):
+        rules = rules if rules else ScanRules()
+        self._snapshot["created"] = time.time()    # start of the file list (file mtimes change with compact)
+        self._snapshot["scan_rules"] = rules.describe()
+        for dir, _, files, _ in rules.walk(rootdir):
             dir_path = Path(dir)
             for filename in files:
                 file_path = dir_path / filename               
                 self._snapshot["files"][file_path.as_posix()] = "xxx"
-        self.status = "FILE_LIST"  
+        MD5Snapshot.SNAPSHOT_HYSTORY_DIR.mkdir(parents=True, exist_ok=True)
         self._snapshot["file_name"] = MD5Snapshot.SNAPSHOT_IN_PROGRESS_FILE_PATH.as_posix()
-        self.save_snapshot()                      
+        self.update_file_infos("FILE_LIST")                      
 
 def main():
     # ****** logging init ***********
@@ -90,7 +143,11 @@ def main():
     src = r"D:\Games\World_of_Tanks"
     snap = MD5Snapshot(log)
 
-    snap.create_md5_snapshot(src)
+    MD5Dir.hash_cache = HashCache.from_config(snap.readjson_config())
+    MD5Dir.configure_block_mode(snap.readjson_config())
+    snap.create_md5_snapshot(src, IOThrottle.from_config(snap.readjson_config()))
+    if MD5Dir.hash_cache:
+        MD5Dir.hash_cache.close()
     log.info(f"created snapshot")
     log.info(f"Runtime: --- {snap.runtime_str} sec, bytes={snap.totalbytes}")
     log.info(f"sec/GB={(snap.runtime/snap.totalbytes*1_000_000_000):.3f}")
@@ -1,13 +1,34 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import hashlib
+import json
 import os
 from pathlib import Path
+import sys
 import time
 
 
 class MD5Dir:
 
     MD5HASHES_FILENAME = ".md5_hashes.txt"
+    MD5BLOCKS_FILENAME = ".md5_hashes_blocks.json"   # per-block md5 lists: {filename: {"size", "block_size", "blocks"}}
+    BLOCK_SIZE = 4 * 1024 * 1024
+    BLOCK_MODE_MIN_FILE_SIZE = 64 * 1024 * 1024     # block lists only for large files
+    BLOCK_WORKERS = 4
+    hash_cache = None       # optional HashCache, shared by all md5 users of the process (see get_md5)
+    block_mode = False      # default of create_md5hashes_for_tree / MD5Snapshot, see configure_block_mode
+    update_appended_files = False
+
+    @staticmethod
+    def configure_block_mode(config:dict) -> bool:
+        """ "BLOCK_MODE" of monitoring_config.json --> class settings for the whole process, returns block_mode """
+        conf = config.get("BLOCK_MODE", {}) if config else {}
+        MD5Dir.block_mode = conf.get("enabled", False)
+        MD5Dir.BLOCK_SIZE = conf.get("block_size", MD5Dir.BLOCK_SIZE)
+        MD5Dir.BLOCK_MODE_MIN_FILE_SIZE = conf.get("min_file_size", MD5Dir.BLOCK_MODE_MIN_FILE_SIZE)
+        MD5Dir.BLOCK_WORKERS = conf.get("workers", MD5Dir.BLOCK_WORKERS)
+        MD5Dir.update_appended_files = conf.get("update_appended_files", False)
+        return MD5Dir.block_mode
 
     def __init__(self):
         pass               
@@ -17,14 +38,153 @@ class MD5Dir:
         return md5.hexdigest()                               
 
     @staticmethod
-    def create_md5_from_file(file_path:Path, chunk_size=4096) -> str:
-        """Calculate the MD5 hash of a file."""
+    def create_md5_from_file(file_path:Path, chunk_size=4096, throttle=None) -> str:
+        """Calculate the MD5 hash of a file (optionally rate limited by an IOThrottle)."""
         md5 = hashlib.md5()
         with open(file_path, "rb") as f:
-            for chunk in iter(lambda: f.read(chunk_size), b""):
-                md5.update(chunk)
+            if throttle is None:
+                for chunk in iter(lambda: f.read(chunk_size), b""):
+                    md5.update(chunk)
+            else:
+                for chunk in iter(lambda: throttle.read(f), b""):
+                    md5.update(chunk)
         return md5.hexdigest()   
+
+    @staticmethod
+    def get_md5(file_path:Path, purpose:str, throttle=None) -> str:
+        """MD5 of a file through the hash cache (if set); purpose "snapshot", "transfer" or "validation" selects the trust policy."""
+        if MD5Dir.hash_cache is None:
+            return MD5Dir.create_md5_from_file(file_path, throttle=throttle)
+        return MD5Dir.hash_cache.get_md5(file_path, purpose, lambda: MD5Dir.create_md5_from_file(file_path, throttle=throttle))
     
+    @staticmethod
+    def read_block(file_path:Path, block_index:int, block_size:int=None) -> bytes:
+        block_size = block_size or MD5Dir.BLOCK_SIZE
+        if hasattr(os, "pread"):
+            fd = os.open(file_path, os.O_RDONLY)
+            try:
+                return os.pread(fd, block_size, block_index * block_size)
+            finally:
+                os.close(fd)
+        with open(file_path, "rb") as f:
+            f.seek(block_index * block_size)
+            return f.read(block_size)
+
+    @staticmethod
+    def create_block_md5s_from_file(file_path:Path, block_size:int=None, first_block=0, workers:int=None) -> list:
+        """MD5 of every block from first_block to the end of the file, hashed in parallel (hashlib releases the GIL)."""
+        block_size = block_size or MD5Dir.BLOCK_SIZE
+        nrof_blocks = -(-Path(file_path).stat().st_size // block_size)
+        def hash_block(block_index):
+            return hashlib.md5(MD5Dir.read_block(file_path, block_index, block_size)).hexdigest()
+        with ThreadPoolExecutor(max_workers=workers or MD5Dir.BLOCK_WORKERS) as executor:
+            return list(executor.map(hash_block, range(first_block, nrof_blocks)))
+
+    @staticmethod
+    def create_md5_and_blocks_from_file(file_path:Path, block_size:int=None, workers:int=None, throttle=None) -> tuple:
+        """One sequential read: whole-file MD5 in this thread, block MD5s in parallel. Returns (md5, block_entry)."""
+        block_size = block_size or MD5Dir.BLOCK_SIZE
+        md5 = hashlib.md5()
+        futures = []
+        size = 0
+        with ThreadPoolExecutor(max_workers=workers or MD5Dir.BLOCK_WORKERS) as executor, open(file_path, "rb") as f:
+            while True:
+                block = throttle.read(f, block_size) if throttle else f.read(block_size)
+                if not block:
+                    break
+                size += len(block)
+                md5.update(block)
+                futures.append(executor.submit(lambda data: hashlib.md5(data).hexdigest(), block))
+            blocks = [future.result() for future in futures]
+        return (md5.hexdigest(), {"size": size, "block_size": block_size, "md5": md5.hexdigest(), "blocks": blocks})
+
+    @staticmethod
+    def get_corrupted_byte_ranges(file_path:Path, entry:dict, workers:int=None) -> list:
+        """Compares all blocks against the stored block list, returns [(first_byte, last_byte), ...] of bad blocks."""
+        block_size = entry["block_size"]
+        actual_blocks = MD5Dir.create_block_md5s_from_file(file_path, block_size, workers=workers)
+        size = Path(file_path).stat().st_size
+        ranges = []
+        for i in range(max(len(actual_blocks), len(entry["blocks"]))):
+            expected = entry["blocks"][i] if i < len(entry["blocks"]) else None
+            actual = actual_blocks[i] if i < len(actual_blocks) else None
+            if expected != actual:
+                start = i * block_size
+                end = min(start + block_size, max(size, entry["size"])) - 1
+                if ranges and ranges[-1][1] == start - 1:
+                    ranges[-1] = (ranges[-1][0], end)   # merge neighbouring bad blocks
+                else:
+                    ranges.append((start, end))
+        return ranges
+
+    @staticmethod
+    def update_blocks_for_appended_file(file_path:Path, entry:dict, workers:int=None) -> dict:
+        """
+            Append-only files (logs, growing archives): only the new tail blocks are hashed.
+            The last complete stored block is re-checked as guard; returns None if the file
+            was not just appended (shrunk or modified) --> a full rehash is required.
+            The whole-file md5 is unknown afterwards (entry["md5"] = None), the block list is authoritative.
+        """
+        size = Path(file_path).stat().st_size
+        block_size = entry["block_size"]
+        if size < entry["size"]:
+            return None
+        if size == entry["size"]:
+            return entry
+        nrof_full_blocks = entry["size"] // block_size
+        if nrof_full_blocks > 0:
+            guard = hashlib.md5(MD5Dir.read_block(file_path, nrof_full_blocks - 1, block_size)).hexdigest()
+            if guard != entry["blocks"][nrof_full_blocks - 1]:
+                return None
+        tail = MD5Dir.create_block_md5s_from_file(file_path, block_size, first_block=nrof_full_blocks, workers=workers)
+        return {"size": size, "block_size": block_size, "md5": None, "blocks": entry["blocks"][:nrof_full_blocks] + tail}
+
+    def get_dict_from_md5blocks_file(self, md5blocks_filepath:Path) -> dict:
+        if not md5blocks_filepath.exists():
+            return {}
+        with open(md5blocks_filepath, "r", encoding='utf-8') as f:
+            return json.load(f)
+
+    def write_md5blocks_file(self, md5blocks_filepath:Path, file_blocks:dict):
+        if len(file_blocks) == 0:
+            # no large files (or no block mode) --> an old block list would contradict the new md5 hashes
+            if md5blocks_filepath.exists():
+                md5blocks_filepath.unlink()
+            return
+        with open(md5blocks_filepath, "w", encoding='utf-8') as f:
+            json.dump(file_blocks, f, ensure_ascii=False)
+
+    def update_md5blocks_for_tree(self, rootdir:Path) -> tuple:
+        """
+            Refreshes the block lists of grown append-only files (tail blocks only).
+            return: (runtime, updated files, files which need a full rehash)
+        """
+        start_time = time.time()
+        updated, rehash = [], []
+        for dir, _, files in os.walk(rootdir):
+            md5blocks_filepath = Path(dir) / MD5Dir.MD5BLOCKS_FILENAME
+            file_blocks = self.get_dict_from_md5blocks_file(md5blocks_filepath)
+            changed = False
+            for file_name, entry in file_blocks.items():
+                file_path = Path(dir) / file_name
+                if not file_path.exists():
+                    continue
+                new_entry = MD5Dir.update_blocks_for_appended_file(file_path, entry)
+                if new_entry is None:
+                    rehash.append(file_path)
+                elif new_entry is not entry:
+                    file_blocks[file_name] = new_entry
+                    updated.append(file_path)
+                    changed = True
+            if changed:
+                self.write_md5blocks_file(md5blocks_filepath, file_blocks)
+        runtime = time.time() - start_time
+        return (runtime, updated, rehash)
+
+    @staticmethod
+    def is_md5_sidecar(filename:str) -> bool:
+        return filename in [MD5Dir.MD5HASHES_FILENAME, MD5Dir.MD5BLOCKS_FILENAME]
+
     """
         If the md5hashlist_file is not existing --> it will be created (empty file).
     """
@@ -57,7 +217,7 @@ class MD5Dir:
                 filelist = self.get_dict_from_md5hashes_file(md5hashlist_filepath)
 
             for curr_file in files:
-                if curr_file != MD5Dir.MD5HASHES_FILENAME and curr_file not in filelist:
+                if not MD5Dir.is_md5_sidecar(curr_file) and curr_file not in filelist:
                     missinglist.append(dir_path / curr_file)
         return missinglist    
     
@@ -69,7 +229,7 @@ class MD5Dir:
                 f.write(f"{filename}: {file_hash}\n")  
 
     def add_entry_to_md5hash_file(self, md5hashes_filename:Path, file_path:Path):
-        file_hash = MD5Dir.create_md5_from_file(file_path)
+        file_hash = MD5Dir.get_md5(file_path, "transfer")
         with open(md5hashes_filename, "a", encoding='utf-8') as f:
             f.write(f"{file_path.name}: {file_hash}\n")  
     
@@ -87,23 +247,37 @@ class MD5Dir:
         runtime = time.time() - start_time
         return runtime
     
-    def create_md5hashes_for_tree(self, rootdir:Path, overwrite=False, only_one_dir=False) -> tuple:
+    def create_md5hashes_for_tree(self, rootdir:Path, overwrite=False, only_one_dir=False, block_mode=None,
+                                  file_stats:dict=None) -> tuple:
         """
             Traverse the directory and subdirectories, creating '.md5_hashes.txt' 
             with key: value-painrs: filename: md5-hash.
+            block_mode: files >= BLOCK_MODE_MIN_FILE_SIZE additionally get a per-block md5 list
+            in '.md5_hashes_blocks.json' (default: MD5Dir.block_mode). The block list is always
+            rewritten (or removed) together with '.md5_hashes.txt'.
+            file_stats: optional dict, collects (st_mtime_ns, st_size) at hashing time per path relative to rootdir
             return: runtime in milliseconds
         """
+        block_mode = MD5Dir.block_mode if block_mode is None else block_mode
         start_time = time.time()   
         totalbytes = 0  
         for dir, _, files in os.walk(rootdir):
             dir_path = Path(dir)
             file_hashes = {}
+            file_blocks = {}
             for filename in files:
-                if filename == MD5Dir.MD5HASHES_FILENAME:  #dont create checksum for it
+                if MD5Dir.is_md5_sidecar(filename):  #dont create checksum for it
                     continue
                 file_path = dir_path / filename
-                totalbytes = totalbytes + file_path.stat().st_size
-                file_hashes[filename] = MD5Dir.create_md5_from_file(file_path)
+                st = file_path.stat()
+                size = st.st_size
+                if file_stats is not None:
+                    file_stats[file_path.relative_to(Path(rootdir)).as_posix()] = (st.st_mtime_ns, size)
+                totalbytes = totalbytes + size
+                if block_mode and size >= MD5Dir.BLOCK_MODE_MIN_FILE_SIZE:
+                    file_hashes[filename], file_blocks[filename] = MD5Dir.create_md5_and_blocks_from_file(file_path)
+                else:
+                    file_hashes[filename] = MD5Dir.get_md5(file_path, "transfer")
             
             md5hashes_filename = dir_path / MD5Dir.MD5HASHES_FILENAME
             # if overwrite is false --> first check if the '.md5_hashes.txt' already exists:
@@ -111,6 +285,7 @@ class MD5Dir:
                 raise FileExistsError(f"md5hashes-filename already exists: {md5hashes_filename}")    
                 
             self.write_md5hashes_file(md5hashes_filename, file_hashes)
+            self.write_md5blocks_file(dir_path / MD5Dir.MD5BLOCKS_FILENAME, file_blocks)
 
             if only_one_dir: 
                 break  # --> not walking down the tree ... finishing after the work on top-dir.
@@ -121,6 +296,22 @@ class MD5Dir:
     def create_md5hashes_for_dir(self, dir_path:Path, overwrite=False) -> tuple:
         return self.create_md5hashes_for_tree(dir_path, overwrite, only_one_dir=True)
     
+    def validate_file(self, file_path:Path, expected_md5:str, block_entry:dict=None) -> tuple:
+        """
+            returns None if ok, else (expected, actual).
+            With a stored block list of the current file size the blocks are compared and
+            'actual' names the corrupted byte ranges instead of the whole-file md5.
+        """
+        if block_entry and block_entry["size"] == file_path.stat().st_size:
+            bad_ranges = MD5Dir.get_corrupted_byte_ranges(file_path, block_entry)
+            if not bad_ranges:
+                return None
+            return (expected_md5, "corrupted bytes " + ", ".join(f"{start:,}-{end:,}" for start, end in bad_ranges))
+        actual_md5 = MD5Dir.get_md5(file_path, "validation")
+        if actual_md5 != expected_md5:
+            return (expected_md5, actual_md5)
+        return None
+
     def checksum_validation_for_dir(self, dir:Path) -> tuple:
         start_time = time.time() 
         md5hashes_filename = dir / MD5Dir.MD5HASHES_FILENAME 
@@ -128,6 +319,7 @@ class MD5Dir:
         missmatches = {}
          # Load expected hashes from .md5_hashes.txt --> the file will be created if not found!
         expected_hashes = self.get_dict_from_md5hashes_file(md5hashes_filename)          
+        file_blocks = self.get_dict_from_md5blocks_file(dir / MD5Dir.MD5BLOCKS_FILENAME)
         
         # Check each file's MD5 against the expected value
         for file_name, expected_md5 in expected_hashes.items():
@@ -135,21 +327,25 @@ class MD5Dir:
             if not file_path.exists():
                 raise FileNotFoundError(f"File '{file_name}' listed in 'md5_hashes.txt' does not exist in the destination.")
 
-            actual_md5 = MD5Dir.create_md5_from_file(file_path)
-            if actual_md5 != expected_md5:
-                missmatches[file_name] = (expected_md5, actual_md5)
-                print(f"Checksum mismatch for file '{file_name}' in '{dir}': expected {expected_md5}, got {actual_md5}")
+            missmatch = self.validate_file(file_path, expected_md5, file_blocks.get(file_name))
+            if missmatch:
+                missmatches[file_name] = missmatch
+                print(f"Checksum mismatch for file '{file_name}' in '{dir}': expected {missmatch[0]}, got {missmatch[1]}")
         runtime = time.time() - start_time
         return (runtime, missmatches)
     
-    def checksum_validation_for_tree(self, rootdir: Path) -> tuple:
+    def checksum_validation_for_tree(self, rootdir: Path, verified:set=None) -> tuple:
+        """
+            verified: optional set, collects the paths (relative to rootdir) of all files with a correct md5
+        """
         start_time = time.time() 
+        missmatches = {}    # key: file path relative to rootdir
           
         for curdir, dirs, files in os.walk(rootdir):
             md5hashes_filename = Path(curdir) / MD5Dir.MD5HASHES_FILENAME 
-            missmatches = {}
             # Load expected hashes from .md5_hashes.txt --> the file will be created if not found!
             expected_hashes = self.get_dict_from_md5hashes_file(md5hashes_filename)    
+            file_blocks = self.get_dict_from_md5blocks_file(Path(curdir) / MD5Dir.MD5BLOCKS_FILENAME)
 
             # Check each file's MD5 against the expected value
             for file_name, expected_md5 in expected_hashes.items():
@@ -157,42 +353,42 @@ class MD5Dir:
                 if not file_path.exists():
                     raise FileNotFoundError(f"File '{file_name}' listed in 'md5_hashes.txt' does not exist in {curdir}")
 
-                actual_md5 = MD5Dir.create_md5_from_file(file_path)
-                if actual_md5 != expected_md5:
-                    missmatches[file_name] = (expected_md5, actual_md5)
-                    print(f"Checksum mismatch for file '{file_name}' in '{dir}': expected {expected_md5}, got {actual_md5}")
+                missmatch = self.validate_file(file_path, expected_md5, file_blocks.get(file_name))
+                if missmatch:
+                    missmatches[file_path.relative_to(Path(rootdir)).as_posix()] = missmatch
+                    print(f"Checksum mismatch for file '{file_name}' in '{curdir}': expected {missmatch[0]}, got {missmatch[1]}")
+                elif verified is not None:
+                    verified.add(file_path.relative_to(Path(rootdir)).as_posix())
             # end for
         # end walk
         runtime = time.time() - start_time
         return (runtime, missmatches)                      
 
 def main():
+    # usage: python md5dir.py [create|update-blocks] <rootdir>
+    #   create: (re)writes .md5_hashes.txt (and the block lists if "BLOCK_MODE" is enabled in monitoring_config.json)
+    #   update-blocks: hashes only the new tail blocks of grown append-only files
     print("main(): start ...")
-    src = r"C:\tmp\testsrc"
     helper = MD5Dir()
+    config_fn = Path.cwd() / "monitoring_config.json"
+    if config_fn.exists():
+        with open(config_fn, "r", encoding='utf-8') as f:
+            MD5Dir.configure_block_mode(json.load(f))
 
-    #runtime = helper.create_md5hashes_for_subdirs(src, overwrite=True)
-
-    # misslist = helper.get_missing_md5hashes_for_subdirs(src)
-    # print(f"Number of missing hashes: {len(misslist)}")
-    # for m in misslist:
-    #     print(m)
-    # runtime = helper.create_md5hashes_for_filelist(misslist)
-
-    # runtime, fails = helper.checksum_validation_for_dir(Path(src) / "unicode_validation")
-    # print(f"Total checksum violations: {len(fails)}")
-    # for f, hashes in fails.items():
-    #     print(f"{str(f).ljust(40, '.')} old={hashes[0]}")
-    #     print(f"{str(f).ljust(40, '.')} new={hashes[1]}")
-
-    testpath = Path(r"D:\Games\Overwolf")
-    # testpath = Path(r"D:\_privat\projekte\GUIFormExamples")
-    runtime, bytes = helper.create_md5hashes_for_tree(testpath, overwrite=True)
-    
-    print(f"Runtime: --- {runtime:.3f} seconds.  Bytes={bytes}")  
+    if len(sys.argv) < 3 or sys.argv[1] not in ["create", "update-blocks"]:
+        print("usage: python md5dir.py [create|update-blocks] <rootdir>")
+        return
+    testpath = Path(sys.argv[2])
+    if sys.argv[1] == "update-blocks":
+        runtime, updated, rehash = helper.update_md5blocks_for_tree(testpath)
+        print(f"Runtime: --- {runtime:.3f} seconds.  {len(updated)} block lists updated")
+        for file_path in rehash:
+            print(f"    not append-only, needs a full rehash: {file_path}")
+    else:
+        runtime, bytes = helper.create_md5hashes_for_tree(testpath, overwrite=True)
+        print(f"Runtime: --- {runtime:.3f} seconds.  Bytes={bytes}  block_mode={MD5Dir.block_mode}")
     print("main(): all done")
-    
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
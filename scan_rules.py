@@ -0,0 +1,289 @@
+import glob
+import logging
+import os
+import re
+import string
+import time
+
+
+class ScanRules:
+    """
+        Include/exclude rules evaluated during the walk --> excluded directories are pruned and never listed.
+        - gitignore-style globs relative to the scan root: '*', '?', '[...]', '**', trailing '/' = directories only,
+          a '/' inside the pattern anchors it at the root, otherwise it matches at any depth, '!' re-includes.
+          The last matching rule wins. All globs are compiled into one regex (one named group per rule).
+        - size and age thresholds for files (0 = off)
+        - absolute paths which are never entered (e.g. zone S directories inside a zone W root)
+        - stay_on_mount: directories on another device than the scan root are not entered
+          (zone W "*" on posix: every mounted filesystem is a scan root of its own)
+    """
+
+    DEFAULT_EXCLUDES = [".md5_hashes*"]    # checksum sidecars of the data mover
+    VIRTUAL_FILESYSTEMS = ["/proc", "/sys", "/dev", "/run"]
+    VIRTUAL_FILESYSTEM_TYPES = ["proc", "sysfs", "devtmpfs", "devpts", "tmpfs", "ramfs", "cgroup", "cgroup2",
+                                "securityfs", "pstore", "debugfs", "tracefs", "configfs", "fusectl", "mqueue",
+                                "hugetlbfs", "bpf", "autofs", "binfmt_misc", "nsfs", "efivarfs", "rpc_pipefs",
+                                "selinuxfs", "squashfs"]
+
+    def __init__(self, excludes:list=None, max_file_size:int=0, max_age_days:float=0, min_age_seconds:float=0,
+                 exclude_paths:list=None, stay_on_mount=False):
+        self.log = logging.getLogger(os.path.basename(__file__))
+        self._patterns = ScanRules.DEFAULT_EXCLUDES + list(excludes or [])
+        self._max_file_size = max_file_size
+        self._max_age_seconds = max_age_days * 24 * 3600
+        self._min_age_seconds = min_age_seconds
+        self._exclude_paths = {os.path.normcase(os.path.abspath(p)) for p in (exclude_paths or [])}
+        self._stay_on_mount = stay_on_mount
+        self._regex, self._negated = ScanRules.compile(self._patterns)
+
+    @property
+    def stay_on_mount(self) -> bool:
+        return self._stay_on_mount
+
+    @staticmethod
+    def from_config(conf:dict, exclude_paths:list=None) -> 'ScanRules':
+        """ conf: "rules" dict of zone_w_config.json """
+        conf = conf or {}
+        return ScanRules(conf.get("excludes"), conf.get("max_file_size", 0), conf.get("max_age_days", 0),
+                         conf.get("min_age_seconds", 0), exclude_paths, conf.get("stay_on_mount", False))
+
+    def describe(self) -> dict:
+        """ the rules as plain data for the snapshot meta: which part of the tree a snapshot covers """
+        return {"excludes": self._patterns[len(ScanRules.DEFAULT_EXCLUDES):],
+                "max_file_size": self._max_file_size,
+                "max_age_days": self._max_age_seconds / (24 * 3600),
+                "min_age_seconds": self._min_age_seconds,
+                "exclude_paths": sorted(self._exclude_paths),
+                "stay_on_mount": self._stay_on_mount}
+
+    @staticmethod
+    def is_unrestricted(description:dict) -> bool:
+        """ description: of describe(); True if nothing but the md5 sidecars is left out """
+        return not any(description.values())
+
+    #region glob compilation
+    @staticmethod
+    def translate(pattern:str) -> tuple:
+        """ returns (regex, negated) for one gitignore-style pattern, None for blank lines and comments """
+        pattern = pattern.strip()
+        if not pattern or pattern.startswith("#"):
+            return None
+        negated = pattern.startswith("!")
+        if negated:
+            pattern = pattern[1:]
+        dir_only = pattern.endswith("/")
+        pattern = pattern.rstrip("/")
+        anchored = "/" in pattern
+        pattern = pattern.lstrip("/")
+
+        parts = []
+        i = 0
+        while i < len(pattern):
+            if pattern.startswith("**/", i):
+                parts.append("(?:.*/)?")
+                i += 3
+            elif pattern.startswith("/**", i) and i + 3 == len(pattern):
+                parts.append("/.*")
+                i += 3
+            elif pattern.startswith("**", i):
+                parts.append(".*")
+                i += 2
+            elif pattern[i] == "*":
+                parts.append("[^/]*")
+                i += 1
+            elif pattern[i] == "?":
+                parts.append("[^/]")
+                i += 1
+            elif pattern[i] == "[" and "]" in pattern[i + 2:]:
+                end = pattern.index("]", i + 2)
+                chars = pattern[i + 1:end]
+                if chars.startswith("!"):
+                    chars = "^" + chars[1:]
+                chars = chars.replace("\\", "\\\\")
+                parts.append(f"[{chars}]")
+                i = end + 1
+            else:
+                parts.append(re.escape(pattern[i]))
+                i += 1
+        # paths are matched as 'a/b' (file) or 'a/b/' (directory)
+        prefix = "" if anchored else "(?:.*/)?"
+        suffix = "/" if dir_only else "/?"
+        return (prefix + "".join(parts) + suffix, negated)
+
+    @staticmethod
+    def compile(patterns:list) -> tuple:
+        """
+            one regex for all rules: the alternatives are in reversed order, so the first alternative
+            which matches (m.lastgroup) is the last matching rule
+        """
+        rules = [rule for rule in (ScanRules.translate(p) for p in patterns) if rule]
+        if not rules:
+            return (None, [])
+        alternatives = [f"(?P<r{i}>{regex})" for i, (regex, _) in reversed(list(enumerate(rules)))]
+        flags = re.IGNORECASE if os.name == "nt" else 0
+        return (re.compile("|".join(alternatives), flags), [negated for _, negated in rules])
+    #endregion glob compilation
+
+    def is_excluded(self, rel_path:str, is_dir=False) -> bool:
+        """ rel_path: posix path relative to the scan root """
+        if self._regex is None:
+            return False
+        m = self._regex.fullmatch(rel_path + "/" if is_dir else rel_path)
+        if m is None:
+            return False
+        return not self._negated[int(m.lastgroup[1:])]
+
+    @staticmethod
+    def get_rel_path(top:str, path:str) -> str:
+        return path[len(top):].lstrip("/\\").replace("\\", "/")
+
+    def keep_dir(self, top:str, root_dev:int, path:str, dev:int=None) -> bool:
+        if self._exclude_paths and os.path.normcase(os.path.abspath(path)) in self._exclude_paths:
+            return False
+        if self.is_excluded(ScanRules.get_rel_path(top, path), is_dir=True):
+            return False
+        if root_dev is not None:
+            try:
+                if dev is None:
+                    dev = os.lstat(path).st_dev
+            except OSError:
+                return False
+            if dev != root_dev:
+                return False    # mount point of another filesystem
+        return True
+
+    def is_inside_exclude_path(self, path:str) -> bool:
+        norm = os.path.normcase(os.path.abspath(path))
+        return any(norm == p or norm.startswith(p.rstrip("/\\") + os.sep) for p in self._exclude_paths)
+
+    def keep_file(self, top:str, dir_path:str, filename:str, file_stats:dict, now:float) -> bool:
+        """ file_stats: {name: (st_size, st_mtime)} of the scanner, files stat'ed here are added """
+        file_path = os.path.join(dir_path, filename)
+        if self.is_excluded(ScanRules.get_rel_path(top, file_path)):
+            return False
+        if not (self._max_file_size or self._max_age_seconds or self._min_age_seconds):
+            return True
+        if filename not in file_stats:
+            try:
+                st = os.stat(file_path)
+            except OSError:
+                return True     # e.g. broken symlink --> the caller decides
+            file_stats[filename] = (st.st_size, st.st_mtime)
+        size, mtime = file_stats[filename]
+        if self._max_file_size and size > self._max_file_size:
+            return False
+        age = now - mtime
+        if self._max_age_seconds and age > self._max_age_seconds:
+            return False
+        if self._min_age_seconds and age < self._min_age_seconds:
+            return False    # probably still being written
+        return True
+
+    def walk(self, rootdir, scanner=None):
+        """
+            os.walk (or ParallelDirectoryScanner.walk) with the rules applied:
+            yields (dirpath, dirnames, filenames, file_sizes); excluded directories are not entered,
+            excluded files are not in filenames. file_sizes: from the scanner's stat calls; for os.walk
+            only the files stat'ed for size/age thresholds.
+        """
+        top = os.fspath(rootdir)
+        try:
+            root_dev = os.stat(top).st_dev if self._stay_on_mount else None
+        except OSError:
+            return
+        def dir_filter(path:str, dev:int=None) -> bool:
+            return self.keep_dir(top, root_dev, path, dev)
+
+        if scanner:
+            walker = scanner.walk(top, dir_filter=dir_filter, with_stats=True)
+        else:
+            walker = self._os_walk(top, dir_filter)
+        now = time.time()
+        nrof_files = nrof_excluded = 0
+        for dirpath, dirnames, filenames, file_stats in walker:
+            files = [f for f in filenames if self.keep_file(top, dirpath, f, file_stats, now)]
+            nrof_files += len(files)
+            nrof_excluded += len(filenames) - len(files)
+            yield (dirpath, dirnames, files, {name: st[0] for name, st in file_stats.items()})
+        self.log.info(f"scan rules for {top}: {nrof_files} files, {nrof_excluded} files excluded")
+
+    @staticmethod
+    def _os_walk(top:str, dir_filter):
+        for dirpath, dirnames, filenames in os.walk(top):
+            dirnames[:] = [d for d in dirnames if dir_filter(os.path.join(dirpath, d))]
+            yield (dirpath, dirnames, filenames, {})
+
+    #region zone W
+    @staticmethod
+    def get_filesystem_roots() -> list:
+        if os.name == "nt":
+            if hasattr(os, "listdrives"):
+                return os.listdrives()
+            return [f"{letter}:\\" for letter in string.ascii_uppercase if os.path.exists(f"{letter}:\\")]
+        return ScanRules.get_mount_points()
+
+    @staticmethod
+    def get_mount_points() -> list:
+        """ posix: mount points of the real filesystems (/proc/self/mounts), nothing below /proc, /sys ... """
+        try:
+            with open("/proc/self/mounts", "r", encoding='utf-8') as f:
+                lines = f.readlines()
+        except OSError:
+            return ["/"]    # no /proc (e.g. macOS)
+        mount_points = []
+        for line in lines:
+            fields = line.split()
+            if len(fields) < 3 or fields[2] in ScanRules.VIRTUAL_FILESYSTEM_TYPES:
+                continue
+            # blanks etc. are octal escapes, e.g. '\040'
+            mount_point = re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), fields[1])
+            if any(mount_point == v or mount_point.startswith(v + "/") for v in ScanRules.VIRTUAL_FILESYSTEMS):
+                continue
+            if mount_point not in mount_points:
+                mount_points.append(mount_point)
+        return mount_points if mount_points else ["/"]
+
+    @staticmethod
+    def is_other_device(path:str, parent:str) -> bool:
+        try:
+            return os.stat(path).st_dev != os.stat(parent).st_dev
+        except OSError:
+            return False
+
+    @staticmethod
+    def expand_roots(directories:list, keep_mount_points=False) -> list:
+        """
+            zone W entries --> scan roots: "*" = all filesystem roots (posix: mount points), entries
+            with wildcards are expanded (directories only); roots inside another root are dropped
+            (scanned once), with keep_mount_points (stay_on_mount) unless they are on another device
+        """
+        roots = []
+        for entry in directories:
+            if entry == "*":
+                roots.extend(ScanRules.get_filesystem_roots())
+            elif glob.has_magic(entry):
+                roots.extend(p for p in sorted(glob.glob(entry)) if os.path.isdir(p))
+            else:
+                roots.append(entry)
+        unique = []
+        for root in sorted({os.path.abspath(r) for r in roots}, key=len):
+            norm = os.path.normcase(root)
+            parents = [u for u in unique if norm == os.path.normcase(u) or norm.startswith(os.path.normcase(u).rstrip("/\\") + os.sep)]
+            if parents:
+                # the walk of the closest parent root doesn't enter it with stay_on_mount
+                if not (keep_mount_points and ScanRules.is_other_device(root, max(parents, key=len))):
+                    continue
+            unique.append(root)
+        return sorted(unique)
+
+    @staticmethod
+    def plan_zone_w(directories:list, zone_s_directories:list, rules_conf:dict) -> tuple:
+        """ returns (scan roots, ScanRules); zone S directories (and /proc, /sys ... for "*") are never entered """
+        exclude_paths = list(zone_s_directories)
+        if "*" in directories and os.name != "nt":
+            exclude_paths.extend(ScanRules.VIRTUAL_FILESYSTEMS)
+        rules = ScanRules.from_config(rules_conf, exclude_paths)
+        # e.g. a zone S directory which is a mount point of its own is no scan root
+        roots = [root for root in ScanRules.expand_roots(directories, rules.stay_on_mount) if not rules.is_inside_exclude_path(root)]
+        return (roots, rules)
+    #endregion zone W
@@ -4,6 +4,9 @@ import logging
 import os
 from pathlib import Path
 
+from snapshot_reader import SnapshotReader
+from snapshot_store import SnapshotStore
+
 
 class Snapshot:
 
@@ -29,15 +32,19 @@ class Snapshot:
                                 "runtime" : 0,
                                 "runtime seconds" : "Runtime: 0 seconds",               
                              }   
+            self.status = "INIT"
+            self._nroffiles = 0
+            self._totalbytes = 0
+            self._runtime = 0
                 
     def load_snapshot(self, file:Path):        
         with open(file, "r",  encoding='utf-8') as f:
             self._snapshot = json.load(f)
 
         self.status = self._snapshot["status"]  
-        self.nroffiles = Snapshot.get_nroffiles_from_snapshot()
-        self.totalbytes = Snapshot.get_totalbytes_from_snapshot()
-        self.runtime = Snapshot.get_runtime_from_snapshot() 
+        self.nroffiles = self.get_nroffiles_from_snapshot()
+        self.totalbytes = self.get_totalbytes_from_snapshot()
+        self.runtime = self.get_runtime_from_snapshot() 
 
     #region properties
     @property
@@ -64,7 +71,7 @@ class Snapshot:
     def nroffiles(self):
         return self._nroffiles
     @nroffiles.setter
-    def nrofffiles(self, newval:int):
+    def nroffiles(self, newval:int):
         self._nroffiles = newval
     
     @property
@@ -91,13 +98,15 @@ class Snapshot:
     def get_runtime_from_snapshot(self) -> float:
         return float(self._snapshot["runtime"])
 
-    def update_file_infos(self, status:str):
+    def update_file_infos(self, status:str, save=True):
+        self.status = status
         self._snapshot["status"] = status   
         self._snapshot["runtime"] = self.runtime
         self._snapshot["runtime seconds"] = self.get_formatted_runtime_str()
         self._snapshot["totalbytes"] = f"{self._totalbytes:,}".replace(",", "'")
         self._snapshot["nroffiles"] = self.nroffiles
-        self.save_snapshot()  
+        if save:
+            self.save_snapshot()  
         self.log.info(f"updated snapshot infos: {self}")
 
     def get_formatted_runtime_str(self)->str:        
@@ -108,7 +117,7 @@ class Snapshot:
     def readjson_config(self):        
         data = {}
         config_fn = Path.cwd() / "monitoring_config.json"
-        if not Path(self.snapshot_in_progress_file_path).exists():
+        if not config_fn.exists():
             self.log.error(f"monitoring_config.json not found in {Path.cwd()} ")
             raise FileNotFoundError(config_fn)
         
@@ -119,6 +128,17 @@ class Snapshot:
                 self.log.error(f"Could not decode json config file: {config_fn}")
                 raise json_decode_error
         return data
+
+    def get_snapshot_store(self, history_dir:Path) -> SnapshotStore:
+        # base snapshots + compressed deltas, see snapshot_store.py
+        return SnapshotStore.from_config(Path(history_dir), self._snapshot_filename_ending, self.readjson_config())
+
+    def get_snapshot_reader(self, history_dir:Path, number:int=None) -> SnapshotReader:
+        # paged access to one snapshot of the history (default: the last one)
+        store = self.get_snapshot_store(history_dir)
+        if number is None:
+            number = store.get_last_snapshot_number()
+        return SnapshotReader.for_history(store, number)
     
 
     def get_snapshot_history_file_list(self) -> list[str]:       
@@ -0,0 +1,232 @@
+import csv
+from datetime import datetime
+import gzip
+import heapq
+import json
+import logging
+import os
+from pathlib import Path, PurePosixPath
+import tempfile
+import time
+
+from snapshot_reader import SnapshotReader
+from snapshot_store import SnapshotStore
+
+
+class SnapshotDiff:
+    """
+        Streaming diff of two snapshots (-VS.json elements or -md5.json files) with constant memory:
+        - the entries of both snapshots are sorted by (parent dir, name) with an external merge sort
+          (sorted runs of RUN_SIZE entries in temporary files, heapq.merge)
+        - a merge join emits the changes '+' added, '-' removed, '~' changed (size or md5) in sorted order
+          into system/reports/diff-<old>-<new>-<ts>.csv.gz / .jsonl.gz
+        - added/removed/changed files and bytes are aggregated per directory (flushed when the parent
+          dir changes) into diff-...-dirs.csv.gz
+        - alerts (logged as warnings, listed in the summary): mass deletion, change rate per hour
+          between the two snapshots, files with ransomware-like extensions
+    """
+
+    REPORT_DIR = Path.cwd() / "system" / "reports"
+    RUN_SIZE = 200_000
+    MAX_DELETED_FILES = 1000
+    MAX_DELETED_RATIO = 0.2     # of the files in the old snapshot
+    MAX_CHANGES_PER_HOUR = 5000
+    MAX_SUSPICIOUS_FILES = 10
+    SUSPICIOUS_EXTENSIONS = [".encrypted", ".enc", ".locked", ".crypt", ".crypto", ".crypted", ".locky",
+                             ".wncry", ".wcry", ".cerber", ".zepto", ".ryk", ".conti", ".lockbit"]
+    CSV_FIELDS = ["change", "type", "path", "old_size", "new_size", "old_md5", "new_md5"]
+    DIR_FIELDS = ["dir", "added_files", "removed_files", "changed_files", "added_bytes", "removed_bytes", "changed_bytes"]
+
+    def __init__(self, report_dir:Path=REPORT_DIR, max_deleted_files:int=MAX_DELETED_FILES,
+                 max_deleted_ratio:float=MAX_DELETED_RATIO, max_changes_per_hour:int=MAX_CHANGES_PER_HOUR,
+                 max_suspicious_files:int=MAX_SUSPICIOUS_FILES, suspicious_extensions:list=None):
+        self.log = logging.getLogger(os.path.basename(__file__))
+        self._report_dir = Path(report_dir)
+        self._max_deleted_files = max_deleted_files
+        self._max_deleted_ratio = max_deleted_ratio
+        self._max_changes_per_hour = max_changes_per_hour
+        self._max_suspicious_files = max_suspicious_files
+        self._suspicious_extensions = tuple(e.lower() for e in (suspicious_extensions or SnapshotDiff.SUSPICIOUS_EXTENSIONS))
+
+    @staticmethod
+    def from_config(config:dict) -> 'SnapshotDiff':
+        conf = config.get("DIFF_ALERTS", {}) if config else {}
+        return SnapshotDiff(SnapshotDiff.REPORT_DIR,
+                            conf.get("max_deleted_files", SnapshotDiff.MAX_DELETED_FILES),
+                            conf.get("max_deleted_ratio", SnapshotDiff.MAX_DELETED_RATIO),
+                            conf.get("max_changes_per_hour", SnapshotDiff.MAX_CHANGES_PER_HOUR),
+                            conf.get("max_suspicious_files", SnapshotDiff.MAX_SUSPICIOUS_FILES),
+                            conf.get("suspicious_extensions"))
+
+    #region external sort
+    @staticmethod
+    def to_entry(item) -> list:
+        """ element dict or (path, md5) tuple --> [parent, name, type, size, md5] (json-serializable, sortable) """
+        if isinstance(item, dict):
+            path, entry_type = item["path"], item["type"]
+            size = int(item["file_length"].replace(",", "").replace("'", "")) if "file_length" in item else None
+            md5 = None
+        else:
+            path, entry_type, size, md5 = item[0], "FILE", None, item[1]
+        p = PurePosixPath(path)
+        return [str(p.parent), p.name, entry_type, size, md5]
+
+    @staticmethod
+    def _iter_run(run_path:Path):
+        with gzip.open(run_path, "rt", encoding='utf-8') as f:
+            for line in f:
+                yield json.loads(line)
+
+    def iter_sorted(self, items, work_dir:Path):
+        """ yields the entries sorted by (parent, name); memory: one run of RUN_SIZE entries """
+        run_paths = []
+        run = []
+        for item in items:
+            run.append(SnapshotDiff.to_entry(item))
+            if len(run) >= SnapshotDiff.RUN_SIZE:
+                run_paths.append(self._write_run(sorted(run), work_dir, len(run_paths)))
+                run = []
+        if not run_paths:
+            yield from sorted(run)      # small snapshot: no temporary files
+            return
+        if run:
+            run_paths.append(self._write_run(sorted(run), work_dir, len(run_paths)))
+        yield from heapq.merge(*[SnapshotDiff._iter_run(p) for p in run_paths])
+
+    def _write_run(self, run:list, work_dir:Path, nr:int) -> Path:
+        run_path = work_dir / f"run-{id(run):x}-{nr:05d}.jsonl.gz"
+        with gzip.open(run_path, "wt", encoding='utf-8', compresslevel=1) as f:
+            for entry in run:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        return run_path
+    #endregion external sort
+
+    @staticmethod
+    def merge_join(old_entries, new_entries):
+        """ yields (change, old_entry, new_entry) for every difference, in (parent, name) order """
+        old = next(old_entries, None)
+        new = next(new_entries, None)
+        while old is not None or new is not None:
+            if new is None or (old is not None and old[:2] < new[:2]):
+                yield ("-", old, None)
+                old = next(old_entries, None)
+            elif old is None or new[:2] < old[:2]:
+                yield ("+", None, new)
+                new = next(new_entries, None)
+            else:
+                if old[2] != new[2] or old[3] != new[3] or old[4] != new[4]:
+                    yield ("~", old, new)
+                old = next(old_entries, None)
+                new = next(new_entries, None)
+
+    def diff(self, old_reader:SnapshotReader, new_reader:SnapshotReader, hours_between:float=None, name:str="diff") -> dict:
+        """ streams the differences into the reports, returns the summary (incl. alerts) """
+        start_time = time.time()
+        self._report_dir.mkdir(parents=True, exist_ok=True)
+        report_base = self._report_dir / f"{name}-{datetime.now():%Y%m%d-%H%M%S}"
+        summary = {"added_files": 0, "removed_files": 0, "changed_files": 0, "added_dirs": 0, "removed_dirs": 0,
+                   "added_bytes": 0, "removed_bytes": 0, "changed_bytes": 0, "old_files": 0, "suspicious_files": 0,
+                   "changed_dirs": 0, "hours_between": hours_between}
+        def count_old_files(items):
+            for item in items:
+                if not isinstance(item, dict) or item["type"] == "FILE":
+                    summary["old_files"] += 1
+                yield item
+
+        current_dir, dir_stats = None, None
+        with tempfile.TemporaryDirectory(dir=self._report_dir) as work_dir, \
+             gzip.open(f"{report_base}.csv.gz", "wt", encoding='utf-8', newline="") as csv_file, \
+             gzip.open(f"{report_base}.jsonl.gz", "wt", encoding='utf-8') as jsonl_file, \
+             gzip.open(f"{report_base}-dirs.csv.gz", "wt", encoding='utf-8', newline="") as dirs_file:
+            changes_csv = csv.writer(csv_file)
+            changes_csv.writerow(SnapshotDiff.CSV_FIELDS)
+            dirs_csv = csv.writer(dirs_file)
+            dirs_csv.writerow(SnapshotDiff.DIR_FIELDS)
+            def flush_dir():
+                if dir_stats and any(dir_stats[1:4]):
+                    dirs_csv.writerow([current_dir] + dir_stats[1:])
+                    summary["changed_dirs"] += 1
+
+            old_entries = self.iter_sorted(count_old_files(old_reader.iter_elements()), Path(work_dir))
+            new_entries = self.iter_sorted(new_reader.iter_elements(), Path(work_dir))
+            for change, old, new in SnapshotDiff.merge_join(old_entries, new_entries):
+                entry = new if new is not None else old
+                parent, entry_name, entry_type = entry[0], entry[1], entry[2]
+                path = str(PurePosixPath(parent, entry_name))    # "/r", not "//r" below a root
+                old_size = old[3] if old else None
+                new_size = new[3] if new else None
+                row = [change, entry_type, path, old_size, new_size, old[4] if old else None, new[4] if new else None]
+                changes_csv.writerow(row)
+                jsonl_file.write(json.dumps(dict(zip(SnapshotDiff.CSV_FIELDS, row)), ensure_ascii=False) + "\n")
+                if entry_type == "DIR":
+                    if change == "+":
+                        summary["added_dirs"] += 1
+                    elif change == "-":
+                        summary["removed_dirs"] += 1
+                    continue
+
+                if parent != current_dir:
+                    flush_dir()
+                    # [dir, added, removed, changed, added_bytes, removed_bytes, changed_bytes]
+                    current_dir, dir_stats = parent, [parent, 0, 0, 0, 0, 0, 0]
+                if change == "+":
+                    dir_stats[1] += 1
+                    dir_stats[4] += new_size or 0
+                    summary["added_files"] += 1
+                    summary["added_bytes"] += new_size or 0
+                elif change == "-":
+                    dir_stats[2] += 1
+                    dir_stats[5] += old_size or 0
+                    summary["removed_files"] += 1
+                    summary["removed_bytes"] += old_size or 0
+                else:
+                    dir_stats[3] += 1
+                    dir_stats[6] += (new_size or 0) - (old_size or 0)
+                    summary["changed_files"] += 1
+                    summary["changed_bytes"] += (new_size or 0) - (old_size or 0)
+                if change != "-" and entry_name.lower().endswith(self._suspicious_extensions):
+                    summary["suspicious_files"] += 1
+            flush_dir()
+        summary["alerts"] = self.check_alerts(summary)
+        summary["runtime"] = time.time() - start_time
+        summary["reports"] = [f"{report_base}{ending}" for ending in [".csv.gz", ".jsonl.gz", "-dirs.csv.gz"]]
+        with open(f"{report_base}-summary.json", "w", encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False, indent=4)
+        return summary
+
+    def check_alerts(self, summary:dict) -> list:
+        alerts = []
+        removed = summary["removed_files"]
+        if removed >= self._max_deleted_files or (summary["old_files"] and removed / summary["old_files"] >= self._max_deleted_ratio
+                                                  and removed >= 10):
+            alerts.append(f"mass deletion: {removed:,} of {summary['old_files']:,} files removed")
+        nrof_changes = summary["added_files"] + removed + summary["changed_files"]
+        if summary["hours_between"]:
+            rate = nrof_changes / max(summary["hours_between"], 1 / 60)
+            if rate >= self._max_changes_per_hour:
+                alerts.append(f"churn: {nrof_changes:,} changed files in {summary['hours_between']:.2f} hours ({rate:,.0f}/hour)")
+        if summary["suspicious_files"] >= self._max_suspicious_files:
+            alerts.append(f"ransomware-like extensions: {summary['suspicious_files']:,} new or changed files")
+        for alert in alerts:
+            self.log.warning(f"ALERT {alert}")
+        return alerts
+
+    def diff_history(self, store:SnapshotStore, old_number:int, new_number:int) -> dict:
+        """
+            diff of two snapshots of a SnapshotStore; the time between them comes from their "created"
+            meta data (the file mtimes change with compact); both snapshots are streamed from the store
+        """
+        old_reader = SnapshotReader.for_history(store, old_number)
+        new_reader = SnapshotReader.for_history(store, new_number)
+        hours_between = abs(store.get_created(new_number) - store.get_created(old_number)) / 3600
+        return self.diff(old_reader, new_reader, hours_between, f"diff-{old_number:04d}-{new_number:04d}")
+
+    @staticmethod
+    def print_summary(summary:dict):
+        print(f"    +{summary['added_files']:,} / -{summary['removed_files']:,} / ~{summary['changed_files']:,} files, "
+              f"+{summary['added_dirs']:,} / -{summary['removed_dirs']:,} dirs in {summary['changed_dirs']:,} changed dirs")
+        print(f"    bytes: +{summary['added_bytes']:,} / -{summary['removed_bytes']:,} / ~{summary['changed_bytes']:+,}")
+        for alert in summary["alerts"]:
+            print(f"    ALERT: {alert}")
+        for report in summary["reports"]:
+            print(f"    report: {report}")
@@ -0,0 +1,309 @@
+import codecs
+import itertools
+import json
+import logging
+import os
+from pathlib import Path, PurePosixPath
+import time
+
+
+class JsonStream:
+    """
+        Minimal streaming json scanner on a binary file, keeps track of byte offsets so
+        single items of a big array/object can be found and re-read later with seek().
+    """
+
+    CHUNK_SIZE = 1024 * 1024
+    WHITESPACE = " \t\r\n"
+
+    def __init__(self, f, start:int=0, end:int=None):
+        self._f = f
+        self._f.seek(start)
+        self._remaining = None if end is None else end - start
+        self._decoder = codecs.getincrementaldecoder("utf-8")()
+        self._json_decoder = json.JSONDecoder()
+        self._buf = ""
+        self._pos = 0
+        self._byte_pos = start
+        self._eof = False
+
+    @property
+    def byte_pos(self):
+        return self._byte_pos
+
+    def _fill(self, chunk_size:int=CHUNK_SIZE) -> bool:
+        if self._eof:
+            return False
+        # drop the consumed part of the buffer --> memory stays at about one chunk (or one value)
+        self._buf = self._buf[self._pos:]
+        self._pos = 0
+        size = chunk_size if self._remaining is None else min(chunk_size, self._remaining)
+        data = self._f.read(size) if size > 0 else b""
+        if self._remaining is not None:
+            self._remaining -= len(data)
+        if not data:
+            self._eof = True
+            self._buf += self._decoder.decode(b"", final=True)
+            return False
+        self._buf += self._decoder.decode(data)
+        return True
+
+    def peek(self) -> str:
+        """ returns the next non whitespace character without consuming it ('' at the end) """
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos] in JsonStream.WHITESPACE:
+                self._pos += 1
+                self._byte_pos += 1
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill():
+                return ""
+
+    def expect(self, chars:str) -> str:
+        ch = self.peek()
+        if ch == "" or ch not in chars:
+            raise ValueError(f"json stream: expected one of '{chars}' at byte {self._byte_pos}, got '{ch}'")
+        self._pos += 1
+        self._byte_pos += 1
+        return ch
+
+    def decode(self) -> tuple:
+        """ returns (value, start_byte, end_byte) of the next json value """
+        self.peek()
+        # every failed attempt parses the value from its start again --> read geometrically more,
+        # so a big value (e.g. the "blocks" map) costs O(n) instead of O(n^2)
+        chunk_size = JsonStream.CHUNK_SIZE
+        while True:
+            try:
+                value, end = self._json_decoder.raw_decode(self._buf, self._pos)
+                # a value ending exactly at the buffer end could be a truncated number
+                if end < len(self._buf) or self._eof:
+                    break
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise
+            self._fill(chunk_size)
+            chunk_size = max(chunk_size, len(self._buf))
+        start_byte = self._byte_pos
+        self._byte_pos += len(self._buf[self._pos:end].encode("utf-8"))
+        self._pos = end
+        return (value, start_byte, self._byte_pos)
+
+
+class SnapshotReader:
+    """
+        Paged reading of a plain json snapshot (-VS.json with "elements", -md5.json with "files").
+        A directory offset index (<snapshot>.idx, rebuilt when the snapshot changes) holds the
+        byte ranges of the entries of every directory, so a subtree can be loaded without
+        parsing the whole file. Memory is proportional to the requested slice (+ the index).
+    """
+
+    INDEX_FILE_ENDING = ".idx"
+    CACHE_FILES = 4     # materialized store snapshots kept in the reader cache (least recently used are removed)
+
+    def __init__(self, file_path:Path, store=None, number:int=None):
+        """ store/number: file_path is the (lazily materialized) cache file of a base/delta snapshot of the store """
+        self.log = logging.getLogger(os.path.basename(__file__))
+        self._file_path = Path(file_path)
+        self._store = store
+        self._number = number
+        self._index = None
+
+    @property
+    def file_path(self):
+        return self._file_path
+
+    @staticmethod
+    def get_entry_dir(collection:str, item) -> str:
+        if collection == "elements":
+            if item["type"] == "DIR":
+                return item["path"]
+            return str(PurePosixPath(item["path"]).parent)
+        return str(PurePosixPath(item[0]).parent)
+
+    #region streaming
+    def _iter_items(self, stream:JsonStream, collection:str, closing:str):
+        """ yields (item, start_byte, end_byte); item = element dict or (path, md5) tuple """
+        while stream.peek() not in [closing, ""]:
+            if collection == "elements":
+                item, start, end = stream.decode()
+            else:
+                key, start, _ = stream.decode()
+                stream.expect(":")
+                value, _, end = stream.decode()
+                item = (key, value)
+            yield (item, start, end)
+            if stream.peek() == ",":
+                stream.expect(",")
+
+    def _iter_file(self, f, on_meta=None):
+        """ streams the whole snapshot: yields (collection, item, start_byte, end_byte) """
+        stream = JsonStream(f)
+        stream.expect("{")
+        while stream.peek() != "}":
+            key, _, _ = stream.decode()
+            stream.expect(":")
+            if key in ["elements", "files"]:
+                closing = "]" if key == "elements" else "}"
+                stream.expect("[" if key == "elements" else "{")
+                for item, start, end in self._iter_items(stream, key, closing):
+                    yield (key, item, start, end)
+                stream.expect(closing)
+            else:
+                value, _, _ = stream.decode()
+                if on_meta:
+                    on_meta(key, value)
+            if stream.peek() == ",":
+                stream.expect(",")
+
+    def iter_elements(self, dir_path:str=None):
+        """ yields element dicts (-VS.json) or (path, md5) tuples (-md5.json), optionally only of a subtree """
+        if self._store is not None and dir_path is None:
+            # whole snapshot: streamed from the compressed history, no cache file needed
+            for key, value in self._store.iter_entries(self._number):
+                yield value if isinstance(value, dict) else (key, value)
+            return
+        self.materialize()
+        with open(self._file_path, "rb") as f:
+            if dir_path is None:
+                for _, item, _, _ in self._iter_file(f):
+                    yield item
+                return
+            index = self.get_index()
+            for start, end in self.get_ranges(dir_path):
+                stream = JsonStream(f, start, end)
+                for item, _, _ in self._iter_items(stream, index["collection"], ""):
+                    yield item
+    #endregion streaming
+
+    #region index
+    def build_index(self) -> dict:
+        stat = self._file_path.stat()
+        index = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "collection": "elements", "meta": {}, "dirs": {}}
+        def on_meta(key, value):
+            if key != "blocks":     # per-block hash lists are not paged
+                index["meta"][key] = value
+        last_dir = None
+        with open(self._file_path, "rb") as f:
+            for collection, item, start, end in self._iter_file(f, on_meta):
+                index["collection"] = collection
+                entry_dir = SnapshotReader.get_entry_dir(collection, item)
+                ranges = index["dirs"].setdefault(entry_dir, [])
+                if entry_dir == last_dir:
+                    ranges[-1][1] = end     # consecutive entries of the same directory: one range
+                else:
+                    ranges.append([start, end])
+                last_dir = entry_dir
+        index_path = Path(f"{self._file_path}{SnapshotReader.INDEX_FILE_ENDING}")
+        with open(index_path, "w", encoding='utf-8') as f:
+            json.dump(index, f, ensure_ascii=False)
+        self.log.info(f"built directory index for {self._file_path}: {len(index['dirs'])} directories")
+        return index
+
+    def get_index(self) -> dict:
+        if self._index is not None:
+            return self._index
+        self.materialize()
+        index_path = Path(f"{self._file_path}{SnapshotReader.INDEX_FILE_ENDING}")
+        stat = self._file_path.stat()
+        if index_path.exists():
+            with open(index_path, "r", encoding='utf-8') as f:
+                index = json.load(f)
+            if index["size"] == stat.st_size and index["mtime_ns"] == stat.st_mtime_ns:
+                self._index = index
+                return index
+        self._index = self.build_index()
+        return self._index
+
+    def get_ranges(self, dir_path:str) -> list:
+        """ sorted byte ranges of all entries in dir_path and below """
+        prefix = PurePosixPath(Path(dir_path).as_posix()).as_posix()
+        ranges = []
+        for entry_dir, dir_ranges in self.get_index()["dirs"].items():
+            if entry_dir == prefix or entry_dir.startswith(prefix.rstrip("/") + "/"):
+                ranges.extend(dir_ranges)
+        return sorted(ranges)
+    #endregion index
+
+    def load_subtree(self, dir_path:str) -> dict:
+        """ returns a snapshot dict (meta + elements/files) restricted to dir_path and below """
+        index = self.get_index()
+        snapshot = dict(index["meta"])
+        if index["collection"] == "elements":
+            snapshot["elements"] = list(self.iter_elements(dir_path))
+        else:
+            snapshot["files"] = dict(self.iter_elements(dir_path))
+        return snapshot
+
+    #region store snapshots
+    @staticmethod
+    def for_history(store, number:int, cache_dir:Path=None) -> 'SnapshotReader':
+        """
+            Reader for a snapshot of a SnapshotStore: plain json snapshots are read directly.
+            Base/delta snapshots are streamed from the store; only paged (subtree) access
+            materializes them into cache_dir (default <history>/.reader_cache). The cache file
+            name contains the identity of the history files --> save()/compact() invalidate it.
+        """
+        snapshots = store.list_snapshots()
+        if number not in snapshots:
+            raise FileNotFoundError(f"snapshot number {number:04d} not found in {store.history_dir}")
+        file_path = snapshots[number]
+        if store.get_kind(file_path) == "plain":
+            return SnapshotReader(file_path)
+        cache_dir = Path(cache_dir) if cache_dir else store.history_dir / ".reader_cache"
+        cached_path = cache_dir / f"{file_path.name}.{store.get_identity(number)}.json"
+        return SnapshotReader(cached_path, store, number)
+
+    def materialize(self):
+        """ writes the store snapshot as plain json into the cache (streamed, memory: the deltas of the chain) """
+        if self._store is None:
+            return
+        if self._file_path.exists():
+            # least recently used eviction by atime (the mtime belongs to the .idx validation)
+            os.utime(self._file_path, ns=(time.time_ns(), self._file_path.stat().st_mtime_ns))
+            return
+        cache_dir = self._file_path.parent
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        entries = self._store.iter_entries(self._number)
+        first = next(entries, None)
+        collection = "elements" if first is None or isinstance(first[1], dict) else "files"
+        opening, closing = ("[", "]") if collection == "elements" else ("{", "}")
+        tmp_path = Path(f"{self._file_path}.tmp")
+        with open(tmp_path, "w", encoding='utf-8') as f:
+            f.write("{\n")
+            for key, value in self._store.get_meta(self._number).items():
+                f.write(f"    {json.dumps(key, ensure_ascii=False)}: {json.dumps(value, ensure_ascii=False)},\n")
+            f.write(f'    "{collection}": {opening}')
+            if first:
+                separator = "\n"
+                for key, value in itertools.chain([first], entries):
+                    if collection == "elements":
+                        f.write(f"{separator}        {json.dumps(value, ensure_ascii=False)}")
+                    else:
+                        f.write(f"{separator}        {json.dumps(key, ensure_ascii=False)}: {json.dumps(value, ensure_ascii=False)}")
+                    separator = ",\n"
+            f.write(f"\n    {closing}\n}}\n")
+        os.replace(tmp_path, self._file_path)
+        self.evict_cache(cache_dir)
+
+    def evict_cache(self, cache_dir:Path):
+        # older versions of this snapshot (other identity) and the least recently used beyond CACHE_FILES
+        snapshot_name = self._file_path.name.rsplit(".", 2)[0]
+        cached = []
+        for cache_file in cache_dir.glob("*.json"):
+            if cache_file != self._file_path and cache_file.name.rsplit(".", 2)[0] == snapshot_name:
+                SnapshotReader.remove_cache_file(cache_file)
+            else:
+                cached.append(cache_file)
+        cached.sort(key=lambda cache_file: cache_file.stat().st_atime, reverse=True)
+        for cache_file in cached[SnapshotReader.CACHE_FILES:]:
+            SnapshotReader.remove_cache_file(cache_file)
+
+    @staticmethod
+    def remove_cache_file(cache_file:Path):
+        for file_path in [cache_file, Path(f"{cache_file}{SnapshotReader.INDEX_FILE_ENDING}")]:
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                pass
+    #endregion store snapshots
@@ -0,0 +1,397 @@
+from datetime import datetime
+import gzip
+import hashlib
+import json
+import logging
+import lzma
+import os
+from pathlib import Path
+import sys
+
+from snapshot_reader import JsonStream, SnapshotReader
+
+try:
+    from compression import zstd    # stdlib since python 3.14
+except ImportError:
+    zstd = None
+
+
+class SnapshotStore:
+    """
+        Snapshot history storage with periodic full base snapshots and compressed deltas
+        against the previous snapshot, e.g.:
+            0007-20241019-VS.json.base.xz
+            0008-20241020-VS.json.delta.xz   (only the changes against 0007)
+        Old uncompressed snapshots (0002-20241003-VS.json) are still readable.
+    """
+
+    CODECS = {
+        "zst": lambda fp, mode: zstd.open(fp, mode, encoding=None if "b" in mode else "utf-8"),
+        "xz":  lambda fp, mode: lzma.open(fp, mode, encoding=None if "b" in mode else "utf-8"),
+        "gz":  lambda fp, mode: gzip.open(fp, mode, encoding=None if "b" in mode else "utf-8"),
+    }
+    BASE_INTERVAL = 10   # every n-th snapshot of a chain is written as a full base snapshot
+
+    def __init__(self, history_dir:Path, snapshot_filename_ending:str, codec:str=None, base_interval:int=BASE_INTERVAL):
+        self.log = logging.getLogger(os.path.basename(__file__))
+        self._history_dir = Path(history_dir)
+        self._snapshot_filename_ending = snapshot_filename_ending
+        self._codec = codec if codec else SnapshotStore.default_codec()
+        if self._codec not in SnapshotStore.CODECS or (self._codec == "zst" and zstd is None):
+            raise ValueError(f"invalid or unavailable snapshot codec: {self._codec}")
+        self._base_interval = max(1, base_interval)
+
+    @staticmethod
+    def from_config(history_dir:Path, snapshot_filename_ending:str, config:dict) -> 'SnapshotStore':
+        """ codec and base interval from monitoring_config.json ("SNAPSHOT_CODEC", "SNAPSHOT_BASE_INTERVAL") """
+        config = config or {}
+        return SnapshotStore(Path(history_dir), snapshot_filename_ending, config.get("SNAPSHOT_CODEC"),
+                             config.get("SNAPSHOT_BASE_INTERVAL", SnapshotStore.BASE_INTERVAL))
+
+    @property
+    def history_dir(self):
+        return self._history_dir
+
+    @staticmethod
+    def default_codec() -> str:
+        return "zst" if zstd is not None else "xz"
+
+    #region file names
+    def list_snapshots(self) -> dict:
+        """ returns {snapshot_number: Path} for all (plain, base and delta) snapshot files """
+        snapshots = {}
+        if not self._history_dir.exists():
+            return snapshots
+        for f in self._history_dir.iterdir():
+            if f.is_file() and f.name[:4].isdigit() and self.get_kind(f) is not None:
+                snapshots[int(f.name[:4])] = f
+        return dict(sorted(snapshots.items()))
+
+    def get_kind(self, file_path:Path) -> str:
+        name = Path(file_path).name
+        if name.endswith(self._snapshot_filename_ending):
+            return "plain"
+        for kind in ["base", "delta"]:
+            for ext in SnapshotStore.CODECS:
+                if name.endswith(f"{self._snapshot_filename_ending}.{kind}.{ext}"):
+                    return kind
+        return None
+
+    def get_last_snapshot_number(self) -> int:
+        numbers = list(self.list_snapshots())
+        return numbers[-1] if numbers else 0
+
+    def create_snapshot_filename(self, number:int, kind:str) -> str:
+        strdate = f"{datetime.now().year}{datetime.now().month:02d}{datetime.now().day:02d}"
+        return f"{number:04d}-{strdate}{self._snapshot_filename_ending}.{kind}.{self._codec}"
+    #endregion file names
+
+    #region read/write records
+    def read_record(self, file_path:Path) -> dict:
+        file_path = Path(file_path)
+        if self.get_kind(file_path) == "plain":
+            with open(file_path, "r", encoding='utf-8') as f:
+                return {"kind": "plain", "snapshot": json.load(f)}
+        ext = file_path.suffix[1:]
+        with SnapshotStore.CODECS[ext](file_path, "rt") as f:
+            return json.load(f)
+
+    def write_record(self, file_path:Path, record:dict):
+        ext = Path(file_path).suffix[1:]
+        tmp_path = Path(f"{file_path}.tmp")
+        with SnapshotStore.CODECS[ext](tmp_path, "wt") as f:
+            json.dump(record, f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(tmp_path, file_path)
+    #endregion read/write records
+
+    #region snapshot <-> entries
+    @staticmethod
+    def split_snapshot(snapshot:dict) -> tuple:
+        """ returns (collection_name, meta, entries) where entries is an ordered dict {key: value} """
+        meta = {k: v for k, v in snapshot.items() if k not in ["elements", "files"]}
+        if "elements" in snapshot:
+            return ("elements", meta, {el["path"]: el for el in snapshot["elements"]})
+        return ("files", meta, dict(snapshot.get("files", {})))
+
+    @staticmethod
+    def join_snapshot(collection:str, meta:dict, entries:dict) -> dict:
+        snapshot = dict(meta)
+        if collection == "elements":
+            snapshot["elements"] = list(entries.values())
+        else:
+            snapshot["files"] = entries
+        return snapshot
+
+    @staticmethod
+    def create_delta(old_entries:dict, new_entries:dict) -> dict:
+        removed = [k for k in old_entries if k not in new_entries]
+        changed = {}
+        added = []
+        prev_key = None
+        for key, value in new_entries.items():
+            if key not in old_entries:
+                added.append([prev_key, key, value])   # position: right after prev_key
+            elif old_entries[key] != value:
+                changed[key] = value
+            prev_key = key
+        return {"removed": removed, "changed": changed, "added": added}
+
+    @staticmethod
+    def apply_delta(old_entries:dict, delta:dict) -> dict:
+        return dict(SnapshotStore.apply_delta_stream(iter(old_entries.items()), delta))
+
+    @staticmethod
+    def apply_delta_stream(old_items, delta:dict):
+        """ old_items: iterator of (key, value) --> yields the (key, value) of the new snapshot, memory: size of the delta """
+        removed = set(delta["removed"])
+        changed = delta["changed"]
+        insert_after = {}
+        added_values = {}
+        for prev_key, key, value in delta["added"]:
+            insert_after.setdefault(prev_key, []).append(key)
+            added_values[key] = value
+
+        def added_after(key):
+            stack = list(reversed(insert_after.get(key, [])))
+            while stack:
+                k = stack.pop()
+                yield (k, added_values[k])
+                stack.extend(reversed(insert_after.get(k, [])))
+
+        yield from added_after(None)
+        for key, value in old_items:
+            if key in removed:
+                continue
+            yield (key, changed.get(key, value))
+            yield from added_after(key)
+    #endregion snapshot <-> entries
+
+    #region streaming
+    def iter_entries(self, number:int, snapshots:dict=None):
+        """
+            yields the (key, value) entries of a snapshot without loading it: the base record is
+            streamed from the compressed file, the deltas of the chain are applied on the fly
+        """
+        snapshots = snapshots if snapshots else self.list_snapshots()
+        if number not in snapshots:
+            raise FileNotFoundError(f"snapshot number {number:04d} not found in {self._history_dir}")
+        file_path = snapshots[number]
+        kind = self.get_kind(file_path)
+        if kind == "plain":
+            for item in SnapshotReader(file_path).iter_elements():
+                yield (item["path"], item) if isinstance(item, dict) else item
+        elif kind == "base":
+            yield from self._iter_record_entries(file_path)
+        else:
+            record = self.read_record(file_path)    # a delta record only holds the changes
+            if record["parent"] not in snapshots:
+                raise FileNotFoundError(f"broken delta chain: parent {record['parent']:04d} of snapshot {number:04d} is missing")
+            yield from SnapshotStore.apply_delta_stream(self.iter_entries(record["parent"], snapshots), record["delta"])
+
+    def _iter_record_entries(self, file_path:Path):
+        with SnapshotStore.CODECS[file_path.suffix[1:]](file_path, "rb") as f:
+            stream = JsonStream(f)
+            stream.expect("{")
+            while stream.peek() != "}":
+                key, _, _ = stream.decode()
+                stream.expect(":")
+                if key == "entries":
+                    stream.expect("{")
+                    while stream.peek() not in ["}", ""]:
+                        entry_key, _, _ = stream.decode()
+                        stream.expect(":")
+                        value, _, _ = stream.decode()
+                        yield (entry_key, value)
+                        if stream.peek() == ",":
+                            stream.expect(",")
+                    stream.expect("}")
+                else:
+                    stream.decode()
+                if stream.peek() == ",":
+                    stream.expect(",")
+
+    def get_meta(self, number:int) -> dict:
+        """ meta data (without the per-block hash lists) of a snapshot, the entries are not read """
+        file_path = self.list_snapshots()[number]
+        kind = self.get_kind(file_path)
+        if kind == "plain":
+            return SnapshotReader(file_path).get_index()["meta"]
+        if kind == "delta":
+            return self.read_record(file_path)["meta"]
+        with SnapshotStore.CODECS[file_path.suffix[1:]](file_path, "rb") as f:
+            stream = JsonStream(f)
+            stream.expect("{")
+            while stream.peek() != "}":
+                key, _, _ = stream.decode()
+                stream.expect(":")
+                value, _, _ = stream.decode()   # "meta" is written before "entries"
+                if key == "meta":
+                    return value
+                if stream.peek() == ",":
+                    stream.expect(",")
+        return {}
+
+    def get_created(self, number:int) -> float:
+        """
+            time of the tree the snapshot represents: meta "created"; older snapshots without it:
+            file mtime minus runtime (wrong after compact, which rewrites the files)
+        """
+        meta = self.get_meta(number)
+        if "created" in meta:
+            return float(meta["created"])
+        return self.list_snapshots()[number].stat().st_mtime - float(meta.get("runtime", 0))
+
+    def get_identity(self, number:int) -> str:
+        """ changes whenever a file of the chain up to number is written (save, compact) """
+        identity = hashlib.md5()
+        for nr, file_path in self.list_snapshots().items():
+            if nr <= number:
+                stat = file_path.stat()
+                identity.update(f"{file_path.name}:{stat.st_size}:{stat.st_mtime_ns};".encode("utf-8"))
+        return identity.hexdigest()[:12]
+    #endregion streaming
+
+    def load(self, number:int) -> dict:
+        """ reconstructs the snapshot with the given number (follows the delta chain back to its base) """
+        snapshots = self.list_snapshots()
+        if number not in snapshots:
+            raise FileNotFoundError(f"snapshot number {number:04d} not found in {self._history_dir}")
+        collection, meta, entries, _ = self._load_entries(number, snapshots)
+        return SnapshotStore.join_snapshot(collection, meta, entries)
+
+    def _load_entries(self, number:int, snapshots:dict) -> tuple:
+        # collect the chain back to the base first, then apply the deltas forward
+        chain = []
+        record = self.read_record(snapshots[number])
+        while record["kind"] == "delta":
+            chain.append(record)
+            parent = record["parent"]
+            if parent not in snapshots:
+                raise FileNotFoundError(f"broken delta chain: parent {parent:04d} of snapshot {number:04d} is missing")
+            record = self.read_record(snapshots[parent])
+
+        if record["kind"] == "plain":
+            collection, meta, entries = SnapshotStore.split_snapshot(record["snapshot"])
+            blocks = meta.pop("blocks", None)
+        else:
+            collection, meta, entries = record["collection"], record["meta"], record["entries"]
+            blocks = record.get("blocks")
+        for delta_record in reversed(chain):
+            entries = SnapshotStore.apply_delta(entries, delta_record["delta"])
+            meta = delta_record["meta"]
+            if "blocks_delta" in delta_record:
+                blocks = SnapshotStore.apply_delta(blocks or {}, delta_record["blocks_delta"])
+            elif "blocks" in delta_record:
+                blocks = delta_record["blocks"]
+            else:
+                blocks = None
+        if blocks is not None:
+            meta = dict(meta, blocks=blocks)
+        return (collection, meta, entries, len(chain))
+
+    def create_record(self, collection:str, meta:dict, entries:dict, parent:tuple=None) -> dict:
+        """
+            parent: (number, collection, meta, entries) of the previous snapshot or None --> base.
+            Per-block hash lists (meta["blocks"], see MD5Dir) get their own delta.
+        """
+        meta = dict(meta)
+        blocks = meta.pop("blocks", None)
+        if parent is not None and parent[1] == collection:
+            delta = SnapshotStore.create_delta(parent[3], entries)
+            # a delta only keeps the order if the unchanged entries kept their relative order
+            if list(SnapshotStore.apply_delta(parent[3], delta)) == list(entries):
+                record = {"kind": "delta", "parent": parent[0], "meta": meta, "delta": delta}
+                parent_blocks = parent[2].get("blocks")
+                if blocks is not None and parent_blocks is not None:
+                    record["blocks_delta"] = SnapshotStore.create_delta(parent_blocks, blocks)
+                elif blocks is not None:
+                    record["blocks"] = blocks
+                return record
+        record = {"kind": "base", "collection": collection, "meta": meta, "entries": entries}
+        if blocks is not None:
+            record["blocks"] = blocks
+        return record
+
+    @staticmethod
+    def set_file_name(record:dict, file_path:Path):
+        # meta "file_name" (Snapshot) names the file the snapshot is stored in --> the history file
+        if "file_name" in record["meta"]:
+            record["meta"]["file_name"] = Path(file_path).as_posix()
+
+    def save(self, number:int, snapshot:dict) -> Path:
+        """ stores the snapshot either as new base or as delta against the previous snapshot """
+        collection, meta, entries = SnapshotStore.split_snapshot(snapshot)
+        snapshots = self.list_snapshots()
+        previous = [nr for nr in snapshots if nr < number]
+
+        parent = None
+        if previous:
+            parent_collection, parent_meta, parent_entries, depth = self._load_entries(previous[-1], snapshots)
+            if depth + 1 < self._base_interval:
+                parent = (previous[-1], parent_collection, parent_meta, parent_entries)
+        record = self.create_record(collection, meta, entries, parent)
+
+        file_path = self._history_dir / self.create_snapshot_filename(number, record["kind"])
+        SnapshotStore.set_file_name(record, file_path)
+        self._history_dir.mkdir(parents=True, exist_ok=True)
+        self.write_record(file_path, record)
+        self.log.info(f"saved snapshot {number:04d} as {record['kind']}: {file_path}")
+        return file_path
+
+    def compact(self, keep_from:int=0) -> int:
+        """
+            Rebases the whole history: snapshots with a number < keep_from are dropped,
+            old uncompressed snapshots are converted and all chains are rewritten with the
+            current codec and base interval. Returns the number of snapshots kept.
+        """
+        old_snapshots = self.list_snapshots()
+        new_files = {}
+        parent = None
+        depth = 0
+        for number, old_path in old_snapshots.items():
+            if number < keep_from:
+                continue
+            collection, meta, entries, _ = self._load_entries(number, old_snapshots)
+            record = self.create_record(collection, meta, entries, parent if depth + 1 < self._base_interval else None)
+            depth = depth + 1 if record["kind"] == "delta" else 0
+            # keep the original date part of the file name
+            new_name = f"{old_path.name.split(self._snapshot_filename_ending)[0]}{self._snapshot_filename_ending}.{record['kind']}.{self._codec}"
+            SnapshotStore.set_file_name(record, self._history_dir / new_name)
+            tmp_path = self._history_dir / f"{new_name}.compact"
+            self._write_compact(tmp_path, record)
+            new_files[number] = (tmp_path, self._history_dir / new_name)
+            parent = (number, collection, meta, entries)
+
+        new_paths = set()
+        for tmp_path, new_path in new_files.values():
+            os.replace(tmp_path, new_path)
+            new_paths.add(new_path)
+        for old_path in old_snapshots.values():
+            if old_path not in new_paths:
+                os.remove(old_path)
+        self.log.info(f"compacted snapshot history {self._history_dir}: kept {len(new_files)} of {len(old_snapshots)} snapshots")
+        return len(new_files)
+
+    def _write_compact(self, tmp_path:Path, record:dict):
+        with SnapshotStore.CODECS[self._codec](tmp_path, "wt") as f:
+            json.dump(record, f, ensure_ascii=False, separators=(",", ":"))
+
+
+def main():
+    # usage: python snapshot_store.py <history_dir> <-VS.json|-md5.json> compact [keep_from]
+    if len(sys.argv) < 4 or sys.argv[3] != "compact":
+        print("usage: python snapshot_store.py <history_dir> <-VS.json|-md5.json> compact [keep_from]")
+        return
+    keep_from = int(sys.argv[4]) if len(sys.argv) > 4 else 0
+    # same codec and base interval as the normal saves (Snapshot.get_snapshot_store)
+    config = {}
+    config_fn = Path.cwd() / "monitoring_config.json"
+    if config_fn.exists():
+        with open(config_fn, "r", encoding='utf-8') as f:
+            config = json.load(f)
+    store = SnapshotStore.from_config(Path(sys.argv[1]), sys.argv[2], config)
+    kept = store.compact(keep_from)
+    print(f"main(): compacted {store.history_dir}, {kept} snapshots kept")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_DIR))
+
+from distributed_hashing import ShardCoordinator, ShardQueue
+from md5_snapshot import MD5Snapshot
+
+WORKER_CODE = """
+import sys
+from pathlib import Path
+from distributed_hashing import ShardQueue, ShardWorker
+ShardWorker(ShardQueue(Path(sys.argv[1]), float(sys.argv[2]))).run(wait_for_others=True, poll_interval=0.2)
+"""
+
+
+class DistributedHashingTest(unittest.TestCase):
+    """ coordinator in this process, workers as separate processes sharing a temp dir """
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.tmp = Path(self._tmp.name)
+        self._cwd = os.getcwd()
+        os.chdir(self.tmp)
+        with open("monitoring_config.json", "w", encoding='utf-8') as f:
+            json.dump({}, f)
+        self._history = (MD5Snapshot.SNAPSHOT_HYSTORY_DIR, MD5Snapshot.SNAPSHOT_IN_PROGRESS_FILE_PATH)
+        MD5Snapshot.SNAPSHOT_HYSTORY_DIR = self.tmp / "history"
+        MD5Snapshot.SNAPSHOT_IN_PROGRESS_FILE_PATH = MD5Snapshot.SNAPSHOT_HYSTORY_DIR / MD5Snapshot.SNAPSHOT_IN_PROGRESS_FILE_NAME
+        self.rootdir = self.tmp / "data"
+        self.queue_dir = self.tmp / "queue"
+        self.write_tree(b"first")
+
+    def tearDown(self):
+        MD5Snapshot.SNAPSHOT_HYSTORY_DIR, MD5Snapshot.SNAPSHOT_IN_PROGRESS_FILE_PATH = self._history
+        os.chdir(self._cwd)
+        self._tmp.cleanup()
+
+    def write_tree(self, content:bytes):
+        for i in range(12):
+            file_path = self.rootdir / f"d{i % 3}" / f"f{i:02d}.bin"
+            file_path.parent.mkdir(parents=True, exist_ok=True)
+            file_path.write_bytes(content + bytes([i]) * 1000 * i)
+
+    def get_expected_md5s(self) -> dict:
+        return {p.as_posix(): hashlib.md5(p.read_bytes()).hexdigest() for p in self.rootdir.rglob("*.bin")}
+
+    def run_workers(self, nrof_workers:int, lease_timeout:float):
+        env = dict(os.environ, PYTHONPATH=str(REPO_DIR))
+        workers = [subprocess.Popen([sys.executable, "-c", WORKER_CODE, str(self.queue_dir), str(lease_timeout)],
+                                    cwd=self.tmp, env=env) for _ in range(nrof_workers)]
+        for worker in workers:
+            self.assertEqual(worker.wait(timeout=120), 0)
+
+    def prepare(self, lease_timeout:float=60) -> tuple:
+        snap = MD5Snapshot(logging.getLogger("test"))
+        coordinator = ShardCoordinator(ShardQueue(self.queue_dir, lease_timeout))
+        coordinator.prepare(snap, self.rootdir, 6)
+        return (snap, coordinator)
+
+    def run_once(self, nrof_workers:int=3, lease_timeout:float=60) -> dict:
+        snap, coordinator = self.prepare(lease_timeout)
+        self.run_workers(nrof_workers, lease_timeout)
+        coordinator.wait_for_results(poll_interval=0.1, timeout=60)
+        coordinator.merge(snap)
+        return snap.snapshot["files"]
+
+    def test_several_workers(self):
+        self.assertEqual(self.run_once(), self.get_expected_md5s())
+        # the stored meta names the history file, not the deleted in-progress file
+        store = MD5Snapshot(logging.getLogger("test")).get_snapshot_store(MD5Snapshot.SNAPSHOT_HYSTORY_DIR)
+        history_file = store.list_snapshots()[1]
+        self.assertEqual(store.get_meta(1)["file_name"], history_file.as_posix())
+        self.assertFalse(MD5Snapshot.SNAPSHOT_IN_PROGRESS_FILE_PATH.exists())
+
+    def test_queue_dir_reuse(self):
+        self.run_once()
+        self.write_tree(b"second")     # same names and sizes, other content
+        self.assertEqual(self.run_once(), self.get_expected_md5s())
+        self.assertEqual(len(list((self.queue_dir / "runs").iterdir())), 1)
+
+    def test_lease_reclaim(self):
+        snap, coordinator = self.prepare(lease_timeout=2)
+        queue = ShardQueue(self.queue_dir, 2)
+        # lock of a crashed worker: no heartbeat for an hour
+        lock_path = queue.lock_path("shard-0001")
+        lock_path.write_text(json.dumps({"owner": "crashed-worker", "claimed": time.time() - 3600}))
+        os.utime(lock_path, (time.time() - 3600, time.time() - 3600))
+        self.run_workers(2, 2)
+        coordinator.wait_for_results(poll_interval=0.1, timeout=60)
+        coordinator.merge(snap)
+        self.assertEqual(snap.snapshot["files"], self.get_expected_md5s())
+        self.assertNotEqual(queue.read_json(queue.result_path("shard-0001"))["owner"], "crashed-worker")
+
+    def test_reclaim_race_keeps_fresh_lock(self):
+        self.prepare(lease_timeout=60)
+        queue = ShardQueue(self.queue_dir, 60)
+        lock_path = queue.lock_path("shard-0001")
+        lock_path.write_text(json.dumps({"owner": "worker-b", "claimed": time.time()}))
+        # worker C saw the old lock of a crashed worker, worker B has replaced it since
+        real_stat = Path.stat
+        seen = []
+        def stale_first_stat(path, *args, **kwargs):
+            st = real_stat(path, *args, **kwargs)
+            if path == lock_path and not seen:
+                seen.append(path)
+                return os.stat_result(tuple(st[:7]) + (0, 0, 0))
+            return st
+        with mock.patch.object(Path, "stat", stale_first_stat):
+            self.assertFalse(queue.reclaim_if_expired("shard-0001"))
+        self.assertEqual(queue.read_json(lock_path)["owner"], "worker-b")
+        self.assertEqual([p.name for p in lock_path.parent.iterdir()], [lock_path.name])
+        self.assertFalse(queue.try_claim("shard-0001", "worker-c"))
+
+    def test_merge_refuses_foreign_or_missing_results(self):
+        snap, coordinator = self.prepare()
+        queue = ShardQueue(self.queue_dir)
+        for shard_name in queue.get_shard_names():
+            queue.write_json_atomic(queue.result_path(shard_name), {"run": queue.run_id, "shard_hash": "0" * 32,
+                                    "files": {}, "missing": [], "bytes": 0, "runtime": 0})
+        with self.assertRaises(ValueError):
+            coordinator.merge(snap)
+        for shard_name in queue.get_shard_names():
+            _, shard_hash = queue.read_shard(shard_name)
+            queue.write_json_atomic(queue.result_path(shard_name), {"run": queue.run_id, "shard_hash": shard_hash,
+                                    "files": {}, "missing": [], "bytes": 0, "runtime": 0})
+        with self.assertRaises(RuntimeError):
+            coordinator.merge(snap)     # all files still "xxx"
+
+
+if __name__ == "__main__":
+    unittest.main()
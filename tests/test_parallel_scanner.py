@@ -0,0 +1,120 @@
+import os
+from pathlib import Path
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_DIR))
+
+from parallel_scanner import ParallelDirectoryScanner
+
+DELAY = 0.005   # per listing, like a round trip to an NFS/SMB server
+
+
+class DelayedScandir:
+    """ os.scandir with a fixed latency, records the listed paths """
+
+    def __init__(self, delay:float=DELAY):
+        self.delay = delay
+        self.paths = []
+        self._lock = threading.Lock()
+
+    def __call__(self, path):
+        with self._lock:
+            self.paths.append(path)
+        time.sleep(self.delay)
+        return os.scandir(path)
+
+
+class ParallelDirectoryScannerTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.rootdir = os.path.join(self._tmp.name, "root")
+        # 40 directories: root, 3 dirs with 4 subdirs each, 2 subsubdirs in each of those
+        for i in range(3):
+            for j in range(4):
+                for k in range(2):
+                    Path(self.rootdir, f"d{i}", f"s{j}", f"t{k}").mkdir(parents=True)
+                    Path(self.rootdir, f"d{i}", f"s{j}", f"t{k}", "f.txt").write_text("x" * (i + j + k))
+                Path(self.rootdir, f"d{i}", f"s{j}", "g.bin").write_bytes(b"y" * j)
+        Path(self.rootdir, "top.txt").write_text("top")
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    @staticmethod
+    def walk_serial(rootdir:str, delay:float=DELAY) -> list:
+        result = []
+        for dirpath, dirnames, filenames in os.walk(rootdir):
+            time.sleep(delay)
+            result.append((dirpath, list(dirnames), sorted(filenames)))
+        return result
+
+    def test_same_order_as_os_walk(self):
+        expected = [(dirpath, dirnames, sorted(filenames)) for dirpath, dirnames, filenames in os.walk(self.rootdir)]
+        scanner = ParallelDirectoryScanner(workers=8, scandir_func=DelayedScandir())
+        result = [(dirpath, list(dirnames), sorted(filenames)) for dirpath, dirnames, filenames, _ in scanner.walk(self.rootdir)]
+        self.assertEqual(len(result), 40)
+        self.assertEqual(result, expected)
+
+    def test_faster_than_serial(self):
+        start_time = time.time()
+        self.walk_serial(self.rootdir)
+        serial_time = time.time() - start_time
+        scanner = ParallelDirectoryScanner(workers=8, scandir_func=DelayedScandir())
+        start_time = time.time()
+        nrof_dirs = sum(1 for _ in scanner.walk(self.rootdir))
+        parallel_time = time.time() - start_time
+        self.assertEqual(nrof_dirs, 40)
+        # 40 * 5 ms serial, about one listing per tree level in parallel
+        self.assertLess(parallel_time, serial_time / 2)
+
+    def test_pruned_subtree_is_dropped(self):
+        scandir = DelayedScandir(delay=0.05)
+        scanner = ParallelDirectoryScanner(workers=8, scandir_func=scandir)
+        walked = []
+        for dirpath, dirnames, _, _ in scanner.walk(self.rootdir):
+            walked.append(dirpath)
+            if dirpath == self.rootdir:
+                dirnames.remove("d1")
+        pruned = os.path.join(self.rootdir, "d1")
+        self.assertFalse([p for p in walked if p.startswith(pruned)])
+        # d1 itself was already being listed, nothing below it
+        self.assertFalse([p for p in scandir.paths if p.startswith(pruned + os.sep)])
+
+    def test_dir_filter(self):
+        scandir = DelayedScandir()
+        scanner = ParallelDirectoryScanner(workers=8, scandir_func=scandir)
+        keep = lambda path, dev: os.path.basename(path) != "s2"
+        result = [dirpath for dirpath, _, _, _ in scanner.walk(self.rootdir, dir_filter=keep)]
+        self.assertEqual(len(result), 40 - 3 * 3)
+        self.assertFalse([p for p in scandir.paths if os.sep + "s2" in p])
+
+    def test_failing_listing_raises(self):
+        scandir = DelayedScandir()
+        def failing_scandir(path):
+            if os.path.basename(path) == "s1":
+                raise UnicodeDecodeError("utf-8", b"\xff", 0, 1, "invalid start byte")
+            return scandir(path)
+        scanner = ParallelDirectoryScanner(workers=8, scandir_func=failing_scandir)
+        with self.assertRaises(UnicodeDecodeError):
+            for _ in scanner.walk(self.rootdir):
+                pass
+
+    def test_failing_dir_filter_raises(self):
+        def failing_filter(path, dev):
+            if os.path.basename(path) == "t1":
+                raise ValueError(path)
+            return True
+        scanner = ParallelDirectoryScanner(workers=8, scandir_func=DelayedScandir())
+        with self.assertRaises(ValueError):
+            for _ in scanner.walk(self.rootdir, dir_filter=failing_filter):
+                pass
+
+
+if __name__ == "__main__":
+    unittest.main()
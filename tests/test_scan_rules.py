@@ -0,0 +1,67 @@
+import os
+from pathlib import Path
+import sys
+import tempfile
+import unittest
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_DIR))
+
+from scan_rules import ScanRules
+
+
+class ScanRulesGlobTest(unittest.TestCase):
+    """ gitignore-style globs --> one compiled regex, paths relative to the scan root """
+
+    def assert_excluded(self, patterns:list, excluded:list, kept:list, is_dir=False):
+        rules = ScanRules(patterns)
+        for rel_path in excluded:
+            self.assertTrue(rules.is_excluded(rel_path, is_dir), f"{patterns}: {rel_path} should be excluded")
+        for rel_path in kept:
+            self.assertFalse(rules.is_excluded(rel_path, is_dir), f"{patterns}: {rel_path} should be kept")
+
+    def test_unanchored_matches_at_any_depth(self):
+        self.assert_excluded(["*.tmp"], ["x.tmp", "a/x.tmp", "a/b/c/x.tmp"], ["x.tmpl", "a/x.tmp.txt"])
+
+    def test_star_does_not_cross_directories(self):
+        self.assert_excluded(["docs/*.md"], ["docs/a.md"], ["docs/sub/a.md", "a.md"])
+
+    def test_anchored(self):
+        # a '/' inside the pattern (or a leading one) anchors it at the scan root
+        self.assert_excluded(["/build"], ["build"], ["src/build"], is_dir=True)
+        self.assert_excluded(["docs/*.md"], ["docs/a.md"], ["x/docs/a.md"])
+        self.assert_excluded(["a/**/z"], ["a/z", "a/b/z", "a/b/c/z"], ["x/a/b/z", "a/z/y"])
+
+    def test_dir_only(self):
+        self.assert_excluded(["cache/"], ["cache", "a/cache"], [], is_dir=True)
+        self.assert_excluded(["cache/"], [], ["cache", "a/cache"])
+
+    def test_negated(self):
+        self.assert_excluded(["*.log", "!keep.log"], ["a.log", "x/a.log"], ["keep.log", "x/keep.log"])
+        # the last matching rule wins
+        self.assert_excluded(["!keep.log", "*.log"], ["a.log", "keep.log"], [])
+
+    def test_negated_anchored(self):
+        self.assert_excluded(["*.bin", "!/data/*.bin"], ["a.bin", "other/data/a.bin", "data/sub/a.bin"], ["data/a.bin"])
+
+    def test_character_class(self):
+        self.assert_excluded(["f[0-9].txt"], ["f1.txt", "a/f9.txt"], ["fx.txt", "f10.txt"])
+        self.assert_excluded(["f[!0-9].txt"], ["fx.txt"], ["f1.txt"])
+
+    def test_default_excludes_and_comments(self):
+        self.assert_excluded(["# a comment", "", "  "], [".md5_hashes.txt", "a/.md5_hashes_blocks.json"], ["a.txt", "# a comment"])
+
+    def test_walk_prunes_excluded_dirs(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            for rel_path in ["keep/a.txt", "keep/node_modules/m.js", "build/b.o", "src/build/c.txt", "x.tmp"]:
+                Path(tmp, rel_path).parent.mkdir(parents=True, exist_ok=True)
+                Path(tmp, rel_path).write_text("x")
+            rules = ScanRules(["node_modules/", "/build/", "*.tmp"])
+            walked = {}
+            for dirpath, _, files, _ in rules.walk(tmp):
+                walked[Path(dirpath).relative_to(tmp).as_posix()] = sorted(files)
+            self.assertEqual(walked, {".": [], "keep": ["a.txt"], "src": [], "src/build": ["c.txt"]})
+
+
+if __name__ == "__main__":
+    unittest.main()
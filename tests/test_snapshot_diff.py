@@ -0,0 +1,90 @@
+import csv
+import gzip
+from pathlib import Path
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_DIR))
+
+from snapshot_diff import SnapshotDiff
+from snapshot_store import SnapshotStore
+
+
+def dir_element(path:str) -> dict:
+    return {"type": "DIR", "path": path, "nrof_files": 0}
+
+
+def file_element(path:str, size:int) -> dict:
+    return {"type": "FILE", "path": path, "file_length": f"{size:,}"}
+
+
+class SnapshotDiffTest(unittest.TestCase):
+    """ two directory snapshots of a store, diffed with runs of 2 entries (external sort with many runs) """
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.tmp = Path(self._tmp.name)
+        self.store = SnapshotStore(self.tmp / "history", "-VS.json")
+        old = [dir_element("/"), file_element("/r", 1),
+               dir_element("/data"), file_element("/data/a.txt", 10), file_element("/data/b.txt", 20),
+               file_element("/data/c.txt", 30),
+               dir_element("/data/old"), file_element("/data/old/x.bin", 1000)]
+        new = [dir_element("/"), file_element("/r", 1),
+               dir_element("/data"), file_element("/data/a.txt", 10), file_element("/data/b.txt", 25),
+               file_element("/data/d.txt.locked", 40),
+               dir_element("/data/new"), file_element("/data/new/y.bin", 500)]
+        self.store.save(1, {"created": 1_700_000_000.0, "elements": old})
+        self.store.save(2, {"created": 1_700_007_200.0, "elements": new})
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    @staticmethod
+    def read_changes(summary:dict) -> list:
+        with gzip.open(summary["reports"][0], "rt", encoding='utf-8', newline="") as f:
+            rows = list(csv.reader(f))
+        return [tuple(row[:3]) for row in rows[1:]]
+
+    def test_diff_with_small_runs(self):
+        diff = SnapshotDiff(self.tmp / "reports", suspicious_extensions=[".locked"], max_suspicious_files=1)
+        with mock.patch.object(SnapshotDiff, "RUN_SIZE", 2), \
+             mock.patch.object(SnapshotDiff, "_write_run", autospec=True, side_effect=SnapshotDiff._write_run) as write_run:
+            summary = diff.diff_history(self.store, 1, 2)
+        self.assertGreater(write_run.call_count, 4)     # 8 entries per snapshot --> 4 runs each
+
+        self.assertEqual(self.read_changes(summary), [
+            ("~", "FILE", "/data/b.txt"),
+            ("-", "FILE", "/data/c.txt"),
+            ("+", "FILE", "/data/d.txt.locked"),
+            ("+", "DIR", "/data/new"),
+            ("-", "DIR", "/data/old"),
+            ("+", "FILE", "/data/new/y.bin"),
+            ("-", "FILE", "/data/old/x.bin"),
+        ])
+        expected = {"added_files": 2, "removed_files": 2, "changed_files": 1, "added_dirs": 1, "removed_dirs": 1,
+                    "added_bytes": 540, "removed_bytes": 1030, "changed_bytes": 5, "old_files": 5,
+                    "suspicious_files": 1, "changed_dirs": 3, "hours_between": 2.0}
+        self.assertEqual({key: summary[key] for key in expected}, expected)
+        self.assertEqual(len(summary["alerts"]), 1)     # ransomware-like extension
+
+    def test_same_result_as_in_memory_sort(self):
+        diff = SnapshotDiff(self.tmp / "reports")
+        with mock.patch.object(SnapshotDiff, "RUN_SIZE", 2):
+            external = self.read_changes(diff.diff_history(self.store, 1, 2))
+        in_memory = self.read_changes(diff.diff_history(self.store, 1, 2))
+        self.assertEqual(external, in_memory)
+
+    def test_paths_below_the_root(self):
+        diff = SnapshotDiff(self.tmp / "reports")
+        self.store.save(3, {"created": 1_700_010_000.0, "elements": [dir_element("/"), file_element("/s", 2)]})
+        with mock.patch.object(SnapshotDiff, "RUN_SIZE", 2):
+            changes = self.read_changes(diff.diff_history(self.store, 2, 3))
+        self.assertIn(("-", "FILE", "/r"), changes)
+        self.assertIn(("+", "FILE", "/s"), changes)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,99 @@
+import os
+from pathlib import Path
+import sys
+import tempfile
+import unittest
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_DIR))
+
+from snapshot_store import SnapshotStore
+
+
+def dir_element(path:str, nrof_files:int) -> dict:
+    return {"type": "DIR", "path": path, "nrof_files": nrof_files}
+
+
+def file_element(path:str, size:int) -> dict:
+    return {"type": "FILE", "path": path, "file_length": f"{size:,}"}
+
+
+class SnapshotStoreTest(unittest.TestCase):
+    """ base/delta chains of a history in a temp dir, compared against the snapshots as saved """
+
+    BASE_INTERVAL = 3
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.history_dir = Path(self._tmp.name) / "history"
+        self.store = SnapshotStore(self.history_dir, "-VS.json", base_interval=SnapshotStoreTest.BASE_INTERVAL)
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    @staticmethod
+    def create_snapshot(generation:int) -> dict:
+        # every generation: one file changes its size, one is added in the middle, one is removed
+        elements = [dir_element("/r", 2), file_element("/r/top.txt", 10)]
+        for i in range(6):
+            if i == generation % 6:
+                continue
+            elements.append(file_element(f"/r/f{i}.bin", 100 * i))
+        elements.append(file_element(f"/r/g{generation:02d}.bin", generation))
+        elements.append(dir_element("/r/sub", 1))
+        elements.append(file_element("/r/sub/log.txt", 1000 + generation))
+        return {"file_name": "", "runtime": "0.010", "created": 1_700_000_000.0 + generation, "elements": elements}
+
+    def save_history(self, nrof_snapshots:int) -> dict:
+        snapshots = {}
+        for number in range(1, nrof_snapshots + 1):
+            snapshots[number] = SnapshotStoreTest.create_snapshot(number)
+            self.store.save(number, snapshots[number])
+        return snapshots
+
+    def assert_same_snapshot(self, number:int, expected:dict):
+        loaded = self.store.load(number)
+        self.assertEqual(loaded["elements"], expected["elements"])
+        self.assertEqual(loaded["created"], expected["created"])
+        self.assertEqual(list(self.store.iter_entries(number)), [(el["path"], el) for el in expected["elements"]])
+
+    def test_round_trip_across_base_intervals(self):
+        snapshots = self.save_history(7)
+        kinds = [self.store.get_kind(file_path) for file_path in self.store.list_snapshots().values()]
+        self.assertEqual(kinds, ["base", "delta", "delta", "base", "delta", "delta", "base"])
+        for number, snapshot in snapshots.items():
+            self.assert_same_snapshot(number, snapshot)
+            self.assertEqual(self.store.get_created(number), snapshot["created"])
+
+    def test_meta_names_the_history_file(self):
+        self.save_history(2)
+        for number, file_path in self.store.list_snapshots().items():
+            self.assertEqual(self.store.get_meta(number)["file_name"], file_path.as_posix())
+
+    def test_compact_keep_from(self):
+        snapshots = self.save_history(7)
+        self.assertEqual(self.store.compact(keep_from=3), 5)
+        history = self.store.list_snapshots()
+        self.assertEqual(list(history), [3, 4, 5, 6, 7])
+        # the chains start again at the first kept snapshot
+        self.assertEqual([self.store.get_kind(file_path) for file_path in history.values()],
+                         ["base", "delta", "delta", "base", "delta"])
+        self.assertFalse([name for name in os.listdir(self.history_dir) if name.endswith(".compact")])
+        for number in history:
+            self.assert_same_snapshot(number, snapshots[number])
+            self.assertEqual(self.store.get_meta(number)["file_name"], history[number].as_posix())
+
+    def test_md5_files_round_trip(self):
+        store = SnapshotStore(self.history_dir, "-md5.json", base_interval=2)
+        snapshots = {}
+        for number in range(1, 5):
+            files = {f"/r/f{i}.bin": f"{number * i:032x}" for i in range(number, number + 4)}
+            snapshots[number] = {"status": "DONE", "files": files}
+            store.save(number, snapshots[number])
+        for number, snapshot in snapshots.items():
+            self.assertEqual(store.load(number)["files"], snapshot["files"])
+            self.assertEqual(dict(store.iter_entries(number)), snapshot["files"])
+
+
+if __name__ == "__main__":
+    unittest.main()
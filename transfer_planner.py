@@ -0,0 +1,239 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import json
+import logging
+import os
+from pathlib import Path
+import shutil
+import statistics
+import time
+
+from integrity_data_mover import IntegrityDataMover
+from parallel_scanner import ParallelDirectoryScanner
+from scan_rules import ScanRules
+from snapshot_reader import SnapshotReader
+from snapshot_store import SnapshotStore
+
+
+class TransferPlanner:
+    """
+        Fast planning pass before a zone transfer copies anything:
+        - bytes/files/dirs of the source; directories unchanged since the last directory
+          snapshot take their file names from the snapshot, the sizes are stat'ed (files may have
+          grown in place) and subdirectories unknown to the snapshot are scanned; changed directories
+          are listed again. Snapshots taken with scan rules (excludes, size/age limits) or of the top
+          directory only don't contain the whole tree --> the source is scanned instead
+        - free space and inode headroom on the destination (statvfs)
+        - ETA from the throughput of earlier transfers (system/transfer_history.json)
+    """
+
+    REPORT_DIR = Path.cwd() / "system" / "reports"
+    HISTORY_FILE = Path.cwd() / "system" / "transfer_history.json"
+    SPACE_MARGIN = 0.05             # keep 5% of the transfer size as reserve
+    MD5_SIDECAR_BYTES_PER_FILE = 50  # '.md5_hashes.txt' line per file
+    HISTORY_LENGTH = 20
+    STAT_WORKERS = 16
+
+    def __init__(self, idm:IntegrityDataMover, directory_history_dir:Path=None):
+        self.log = logging.getLogger(os.path.basename(__file__))
+        self._idm = idm
+        self._directory_history_dir = directory_history_dir if directory_history_dir else TransferPlanner.get_directory_history_dir()
+
+    @staticmethod
+    def get_directory_history_dir() -> Path:
+        config_fn = Path.cwd() / "monitoring_config.json"
+        if config_fn.exists():
+            with open(config_fn, "r", encoding='utf-8') as f:
+                config = json.load(f)
+            if "DIRECTORY_HYSTORY_DIR" in config:
+                return Path(config["DIRECTORY_HYSTORY_DIR"])
+        return Path.cwd() / "system" / "directorystructure_snapshots"
+
+    #region source
+    def get_source_stats_from_snapshot(self) -> dict:
+        """ returns None if there is no directory snapshot covering the source """
+        store = SnapshotStore(self._directory_history_dir, "-VS.json")
+        number = store.get_last_snapshot_number()
+        if number == 0:
+            return None
+        # snapshots before the rules were recorded were walked with the default rules
+        meta = store.get_meta(number)
+        if meta.get("only_one_dir") or not ScanRules.is_unrestricted(meta.get("scan_rules", {})):
+            self.log.info(f"snapshot {number} doesn't contain the complete tree (scan rules) --> scanning the source")
+            return None
+        reader = SnapshotReader.for_history(store, number)
+        source = self._idm.sourcepath.as_posix()
+        if not reader.get_ranges(source):
+            return None
+        # the snapshot represents the tree at its creation time
+        snapshot_time = store.get_created(number)
+        snapshot_file = store.list_snapshots()[number]
+
+        stats = {"bytes": 0, "files": 0, "dirs": 0, "cached_dirs": 0, "rescanned_dirs": 0, "snapshot": snapshot_file.name}
+        snapshot_dirs = {el["path"] for el in reader.iter_elements(source) if el["type"] == "DIR"}
+        current_dir, current_files = None, []
+        pending = []    # (files, bytes, new subdirs) of the unchanged directories
+        with ThreadPoolExecutor(max_workers=TransferPlanner.STAT_WORKERS) as executor:
+            def account_dir(dir_path:str, files:list):
+                try:
+                    changed = os.stat(dir_path).st_mtime > snapshot_time
+                except FileNotFoundError:
+                    return      # deleted in the meantime
+                stats["dirs"] += 1
+                if not changed:
+                    # same entries as in the snapshot, but the sizes may have changed
+                    stats["cached_dirs"] += 1
+                    pending.append(executor.submit(TransferPlanner.stat_unchanged_dir, dir_path, files, snapshot_dirs))
+                else:
+                    self.rescan_dir(Path(dir_path), snapshot_dirs, stats)
+
+            for element in reader.iter_elements(source):
+                if element["type"] == "DIR":
+                    if current_dir is not None:
+                        account_dir(current_dir, current_files)
+                    current_dir, current_files = element["path"], []
+                else:
+                    current_files.append(element["path"])
+            if current_dir is not None:
+                account_dir(current_dir, current_files)
+            for future in pending:
+                nrof_files, nrof_bytes, new_subdirs = future.result()
+                stats["files"] += nrof_files
+                stats["bytes"] += nrof_bytes
+                for subdir in new_subdirs:
+                    self.add_scanned_dir(Path(subdir), stats)
+        return stats
+
+    @staticmethod
+    def stat_unchanged_dir(dir_path:str, file_paths:list, snapshot_dirs:set) -> tuple:
+        """ returns (files, bytes, new subdirs): sizes of the files which still exist, subdirs not in the snapshot """
+        nrof_files, nrof_bytes = TransferPlanner.stat_files(file_paths)
+        new_subdirs = []
+        try:
+            with os.scandir(dir_path) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False) and Path(entry.path).as_posix() not in snapshot_dirs:
+                        new_subdirs.append(entry.path)
+        except FileNotFoundError:
+            pass    # deleted in the meantime
+        return (nrof_files, nrof_bytes, new_subdirs)
+
+    @staticmethod
+    def stat_files(file_paths:list) -> tuple:
+        """ returns (files, bytes) of the files which still exist """
+        nrof_files = nrof_bytes = 0
+        for file_path in file_paths:
+            try:
+                nrof_bytes += os.stat(file_path).st_size
+                nrof_files += 1
+            except FileNotFoundError:
+                pass    # deleted in the meantime
+        return (nrof_files, nrof_bytes)
+
+    def add_scanned_dir(self, dir_path:Path, stats:dict):
+        # subdirectory unknown to the snapshot --> completely scanned
+        scanned = self.scan_source(dir_path)
+        for key in ["bytes", "files", "dirs"]:
+            stats[key] += scanned[key]
+        stats["rescanned_dirs"] += scanned["dirs"]
+
+    def rescan_dir(self, dir_path:Path, snapshot_dirs:set, stats:dict):
+        # changed directory: its files again, subdirectories unknown to the snapshot completely
+        stats["rescanned_dirs"] += 1
+        with os.scandir(dir_path) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    if Path(entry.path).as_posix() not in snapshot_dirs:
+                        self.add_scanned_dir(Path(entry.path), stats)
+                else:
+                    stats["files"] += 1
+                    stats["bytes"] += entry.stat().st_size
+
+    def scan_source(self, rootdir:Path) -> dict:
+        stats = {"bytes": 0, "files": 0, "dirs": 0}
+        for _, _, files, file_sizes in ParallelDirectoryScanner().walk(rootdir):
+            stats["dirs"] += 1
+            stats["files"] += len(files)
+            stats["bytes"] += sum(file_sizes.values())
+        return stats
+    #endregion source
+
+    #region destination
+    @staticmethod
+    def get_free_space(dest:Path) -> tuple:
+        """ returns (free_bytes, free_inodes); free_inodes is None where statvfs is missing (windows) """
+        if hasattr(os, "statvfs"):
+            st = os.statvfs(dest)
+            return (st.f_bavail * st.f_frsize, st.f_favail if st.f_files > 0 else None)
+        return (shutil.disk_usage(dest).free, None)
+    #endregion destination
+
+    #region throughput history
+    def load_history(self) -> list:
+        if not TransferPlanner.HISTORY_FILE.exists():
+            return []
+        with open(TransferPlanner.HISTORY_FILE, "r", encoding='utf-8') as f:
+            return json.load(f)
+
+    def record_transfer(self, totalbytes:int, nroffiles:int, seconds:float):
+        history = self.load_history()
+        history.append({"time": time.time(), "bytes": totalbytes, "files": nroffiles, "seconds": seconds})
+        TransferPlanner.HISTORY_FILE.parent.mkdir(parents=True, exist_ok=True)
+        with open(TransferPlanner.HISTORY_FILE, "w", encoding='utf-8') as f:
+            json.dump(history[-TransferPlanner.HISTORY_LENGTH:], f, indent=4)
+
+    def estimate_seconds(self, totalbytes:int) -> float:
+        """ median throughput (hash source + copy + validate) of the earlier transfers, None if unknown """
+        rates = [h["bytes"] / h["seconds"] for h in self.load_history() if h["seconds"] > 0 and h["bytes"] > 0]
+        if not rates:
+            return None
+        return totalbytes / statistics.median(rates)
+    #endregion throughput history
+
+    def create_plan(self) -> dict:
+        start_time = time.time()
+        source_stats = self.get_source_stats_from_snapshot()
+        if source_stats is None:
+            source_stats = self.scan_source(self._idm.sourcepath)
+            source_stats.update({"cached_dirs": 0, "rescanned_dirs": source_stats["dirs"], "snapshot": None})
+
+        free_bytes, free_inodes = TransferPlanner.get_free_space(self._idm.destpath)
+        required_bytes = int(source_stats["bytes"] * (1 + TransferPlanner.SPACE_MARGIN)
+                             + source_stats["files"] * TransferPlanner.MD5_SIDECAR_BYTES_PER_FILE)
+        required_inodes = source_stats["files"] + 2 * source_stats["dirs"]   # files, dirs, .md5_hashes.txt
+        collisions = self._idm.collect_existing_items_in_destination()
+
+        plan = {"source": self._idm.sourcepath.as_posix(),
+                "destination": self._idm.destpath.as_posix(),
+                **source_stats,
+                "required_bytes": required_bytes,
+                "free_bytes": free_bytes,
+                "required_inodes": required_inodes,
+                "free_inodes": free_inodes,
+                "collisions": collisions,
+                "eta_seconds": self.estimate_seconds(source_stats["bytes"]),
+                "planning_seconds": time.time() - start_time}
+        plan["fits"] = (required_bytes <= free_bytes
+                        and (free_inodes is None or required_inodes <= free_inodes)
+                        and not collisions)
+        self.save_plan(plan)
+        return plan
+
+    def save_plan(self, plan:dict) -> Path:
+        TransferPlanner.REPORT_DIR.mkdir(parents=True, exist_ok=True)
+        plan_path = TransferPlanner.REPORT_DIR / f"transfer-plan-{datetime.now():%Y%m%d-%H%M%S}.json"
+        with open(plan_path, "w", encoding='utf-8') as f:
+            json.dump(plan, f, ensure_ascii=False, indent=4)
+        return plan_path
+
+    @staticmethod
+    def print_plan(plan:dict):
+        eta = "unknown (no transfer history)" if plan["eta_seconds"] is None else f"{plan['eta_seconds'] / 60:.1f} minutes"
+        inodes = "n/a" if plan["free_inodes"] is None else f"{plan['free_inodes']:,}"
+        print(f"    plan: {plan['source']} --> {plan['destination']}")
+        print(f"      {plan['files']:,} files in {plan['dirs']:,} dirs, {plan['bytes']:,} bytes "
+              f"({plan['cached_dirs']:,} dirs from snapshot {plan['snapshot']}, {plan['rescanned_dirs']:,} rescanned)")
+        print(f"      space:  required {plan['required_bytes']:,} / free {plan['free_bytes']:,} bytes")
+        print(f"      inodes: required {plan['required_inodes']:,} / free {inodes}")
+        print(f"      collisions: {len(plan['collisions'])}, ETA: {eta}")
+        print(f"      --> {'ok' if plan['fits'] else 'NOT POSSIBLE'}")